@@ -0,0 +1,99 @@
+"""Compare one gunicorn process in the threaded sync mode against the gevent mode.
+
+Starts each mode on a local port with the current environment (database,
+Square and JWT settings as for the web process), holds --connections
+keep-alive clients against --path for --seconds, and reports throughput,
+latency percentiles and errors.
+
+    python benchserve.py --path '/availability/?ids=1' --connections 200 --seconds 10
+"""
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import threading
+import time
+
+parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+parser.add_argument("--path", default="/availability/?ids=1")
+parser.add_argument("--connections", type=int, default=200, help="Concurrent keep-alive clients")
+parser.add_argument("--seconds", type=float, default=10)
+parser.add_argument("--port", type=int, default=8765)
+args = parser.parse_args()
+
+here = os.path.dirname(os.path.abspath(__file__))
+modes = (
+    ("sync --threads 4", ["--threads", "4"]),  # what Procfile runs
+    ("gevent", ["-c", os.path.join(here, "gunicorn_gevent.py")]),
+)
+
+
+def waitUntilServing(process):
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("gunicorn exited with {}".format(process.returncode))
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", args.port, timeout=1)
+            connection.request("GET", args.path)
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit("gunicorn did not start serving within 30s")
+
+
+def client(deadline, latencies, errors, lock):
+    connection = http.client.HTTPConnection("127.0.0.1", args.port, timeout=30)
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            connection.request("GET", args.path)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status < 500
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection("127.0.0.1", args.port, timeout=30)
+            ok = False
+        with lock:
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors[0] += 1
+
+
+def run(flags):
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "src.app:create_app()", "--workers", "1",
+                                "--bind", "127.0.0.1:{}".format(args.port), "--log-level", "warning"] + flags, cwd=here)
+    try:
+        waitUntilServing(process)
+        latencies, errors, lock = [], [0], threading.Lock()
+        deadline = time.monotonic() + args.seconds
+        clients = [threading.Thread(target=client, args=(deadline, latencies, errors, lock)) for _ in range(args.connections)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        return sorted(latencies), errors[0]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    print("{} connections on {} for {:.0f}s, one worker process".format(args.connections, args.path, args.seconds))
+    print("{:<18}{:>10}{:>10}{:>10}{:>10}".format("mode", "req/s", "p50 ms", "p99 ms", "errors"))
+    for name, flags in modes:
+        latencies, errors = run(flags)
+        if not latencies:
+            print("{:<18}{:>10}{:>10}{:>10}{:>10}".format(name, 0, "-", "-", errors))
+            continue
+        print("{:<18}{:>10.1f}{:>10.1f}{:>10.1f}{:>10}".format(
+            name, len(latencies) / args.seconds, 1000 * latencies[len(latencies) // 2],
+            1000 * latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))], errors))
+
+
+if __name__ == "__main__":
+    main()
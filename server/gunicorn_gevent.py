@@ -0,0 +1,18 @@
+# Cooperative serving mode: one process holds many slow connections (Square
+# calls, bcrypt, SMTP) without a thread each.
+#
+#     gunicorn -c gunicorn_gevent.py 'src.app:create_app()'
+#
+# gevent patches sockets, so the Square SDK, Flask-Mail and the replica/primary
+# connections all yield while they wait; psycogreen does the same for psycopg2.
+import os
+
+worker_class = "gevent"
+worker_connections = int(os.environ.get("GEVENT_WORKER_CONNECTIONS", 1000))
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+
+
+def post_fork(server, worker):
+    if os.environ.get("SQLALCHEMY_DATABASE_URI", "").startswith("postgres"):
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,218 @@
+"""On-sale load test: many buyers browse, log in, fill a cart and check out at once.
+
+Runs the app in-process against a scratch database with a fake Square payments
+client and mail suppressed, then reports throughput, latency percentiles,
+status codes and SQL statements per endpoint plus any oversold inventory.
+
+    python loadtest.py --database postgresql://localhost/folda_load --buyers 500 --concurrency 50
+    python loadtest.py  # throwaway SQLite file, one buyer at a time: SQLite ignores FOR UPDATE
+
+The scenario's rows are added next to whatever the database already holds
+and are never cleaned up, so point it at a database you can throw away.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+parser.add_argument("--database", default="sqlite:///" + os.path.join(tempfile.mkdtemp(), "loadtest.db"))
+parser.add_argument("--buyers", type=int, default=200, help="Buyers running the scenario once each")
+parser.add_argument("--concurrency", type=int, default=20, help="Buyers in flight at once")
+parser.add_argument("--capacity", type=int, default=100, help="Day passes on sale")
+parser.add_argument("--events", type=int, default=2, help="Events the day pass admits to")
+parser.add_argument("--quantity", type=int, default=2, help="Tickets each buyer tries to reserve")
+parser.add_argument("--payment-latency", type=float, default=0.2, help="Seconds the fake Square call takes")
+parser.add_argument("--hash-rounds", type=int, default=int(os.environ.get("PASSWORD_HASH_ROUNDS", 12)))
+parser.add_argument("--admission-rate", type=float, default=0, help="Waiting room admissions per second; 0 skips the queue")
+args = parser.parse_args()
+
+# the app reads its configuration at import time
+os.environ.update({
+    "SQLALCHEMY_DATABASE_URI": args.database,
+    "PASSWORD_HASH_ROUNDS": str(args.hash_rounds),
+    "WAITING_ROOM_RATE": str(args.admission_rate),
+    "MAIL_SUPPRESS_SEND": "yes",
+})
+for name, value in (("SQUARE_TOKEN", "loadtest"), ("SQUARE_ENVIRONMENT", "sandbox"),
+                    ("DEBUG_ENABLED", "no"), ("JWT_SECRET_KEY", uuid.uuid4().hex)):
+    os.environ.setdefault(name, value)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests"))
+
+from types import SimpleNamespace  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+from conftest import FakePayment, folda  # noqa: E402
+
+
+def createPayment(body):
+    # stands in for square.payments.create_payment, latency included
+    time.sleep(args.payment_latency)
+    return FakePayment({"payment": {"id": "loadtest-" + body["idempotency_key"][:12], "amount_money": body["amount_money"]}})
+
+
+app = folda.create_app()
+app.extensions["square"] = SimpleNamespace(payments=SimpleNamespace(create_payment=createPayment))
+
+current = threading.local()
+queryCounts = Counter()
+queryCountsLock = threading.Lock()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def countQuery(conn, cursor, statement, parameters, context, executemany):
+    with queryCountsLock:
+        queryCounts[getattr(current, "endpoint", "setup")] += 1
+
+
+def seed():
+    folda.db.create_all()
+    run = uuid.uuid4().hex[:8]
+    ticketClass = folda.TicketClass(description="Adult " + run, priceCents=4500)
+    purchasable = folda.Purchasable(name="Day pass " + run, description="load test", type=folda.PurchasableTypes2.dayPass,
+                                    numTickets=args.capacity)
+    folda.db.session.add_all([ticketClass, purchasable])
+    folda.db.session.flush()
+    folda.db.session.add(folda.Purchasable_TicketClass(purchasable_id=purchasable.id, ticketClass_id=ticketClass.id))
+    events = [folda.Event(purchasable_id=purchasable.id, name="Event {} {}".format(run, i), description="load test",
+                          artistName="Artist", venue="Hall", capacity=args.capacity,
+                          startTime=folda.datetime(2020, 7, 1, 10 + i), endTime=folda.datetime(2020, 7, 1, 11 + i))
+             for i in range(args.events)]
+    folda.db.session.add_all(events)
+    password = folda.hashPassword("loadtest")  # one hash shared by every buyer keeps seeding fast
+    users = [folda.User(name="Buyer {}".format(i), emailAddress="buyer{}-{}@loadtest.invalid".format(i, run), password=password)
+             for i in range(args.buyers)]
+    folda.db.session.add_all(users)
+    folda.db.session.commit()
+    return purchasable.id, ticketClass.id, [e.id for e in events], [(u.id, u.emailAddress) for u in users]
+
+
+latencies = defaultdict(list)
+statuses = defaultdict(Counter)
+resultsLock = threading.Lock()
+
+
+def call(client, endpoint, method, path, **kwargs):
+    current.endpoint = endpoint
+    started = time.perf_counter()
+    response = client.open(path, method=method, **kwargs)
+    elapsed = time.perf_counter() - started
+    current.endpoint = None
+    with resultsLock:
+        latencies[endpoint].append(elapsed)
+        statuses[endpoint][response.status_code] += 1
+    return response
+
+
+def buy(client, purchasableId, ticketClassId, eventIds, userId, emailAddress):
+    call(client, "getPurchasables", "GET", "/purchasables/")
+    call(client, "getPurchasable", "GET", "/purchasables/{}/".format(purchasableId))
+    response = call(client, "authenticate", "POST", "/auth/", json={"emailAddress": emailAddress, "password": "loadtest"})
+    if response.status_code != 200:
+        return
+    headers = {"Authorization": "Bearer " + response.get_json()["access_token"]}
+    if args.admission_rate:
+        status = call(client, "waitingRoom", "POST", "/waitingRoom/", headers=headers).get_json()
+        while not status["admitted"]:
+            time.sleep(max(0.05, min(status["eta"], status["retryAfter"])))
+            status = call(client, "waitingRoom", "GET", "/waitingRoom/", headers=headers).get_json()
+    response = call(client, "addToCart", "POST", "/users/{}/cart/".format(userId), headers=headers, json={
+        "purchasableId": purchasableId, "ticketClassId": ticketClassId, "quantity": args.quantity, "events": eventIds})
+    if response.status_code != 200:
+        return
+    call(client, "getCart", "GET", "/users/{}/cart/".format(userId), headers=headers)
+    call(client, "checkout", "POST", "/checkout/", headers=headers, json={"nonce": "cnon:card-nonce-ok"})
+
+
+def worker(queue, queueLock, scenario):
+    client = app.test_client()
+    while True:
+        with queueLock:
+            if not queue:
+                return
+            userId, emailAddress = queue.pop()
+        try:
+            buy(client, *scenario, userId, emailAddress)
+        except Exception as error:  # keep the other buyers going; the failure is tallied
+            with resultsLock:
+                statuses[getattr(current, "endpoint", None) or "scenario"][type(error).__name__] += 1
+            current.endpoint = None
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def oversold(purchasableId, eventIds):
+    # compare purchased rows against capacity and the live counters
+    db, Ticket, Event_Ticket = folda.db, folda.Ticket, folda.Event_Ticket
+    purchasable = db.session.query(folda.Purchasable).filter(folda.Purchasable.id == purchasableId).one()
+    sold = db.session.query(db.func.count(Ticket.id)).filter(
+        Ticket.purchasable_id == purchasableId, Ticket.isPurchased == True).scalar()
+    report = [("purchasable", purchasable.numTickets, sold, purchasable.soldCount)]
+    for event_ in db.session.query(folda.Event).filter(folda.Event.id.in_(eventIds)).order_by(folda.Event.id):
+        admitted = db.session.query(db.func.count(Event_Ticket.id)).join(Ticket, Ticket.id == Event_Ticket.ticket_id).filter(
+            Event_Ticket.event_id == event_.id, Ticket.isPurchased == True).scalar()
+        report.append(("event {}".format(event_.id), event_.capacity, admitted, event_.soldCount))
+    return report
+
+
+def main():
+    with app.app_context():
+        purchasableId, ticketClassId, eventIds, buyers = seed()
+        isSqlite = folda.db.engine.dialect.name == "sqlite"
+    concurrency = args.concurrency
+    if isSqlite and concurrency > 1:
+        # concurrent buyers would oversell, as nothing locks the inventory rows
+        print("note: SQLite ignores FOR UPDATE, so buyers run one at a time instead of {}; "
+              "pass --database with a Postgres URI to measure contention".format(concurrency))
+        concurrency = 1
+
+    queue, queueLock = list(reversed(buyers)), threading.Lock()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(queue, queueLock, (purchasableId, ticketClassId, eventIds)))
+               for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print("{} buyers, {} at a time, {:.1f}s, {:.1f} requests/s".format(
+        args.buyers, concurrency, elapsed, sum(len(v) for v in latencies.values()) / elapsed))
+    print("{:<16}{:>8}{:>10}{:>9}{:>9}{:>9}{:>11}  statuses".format("endpoint", "calls", "req/s", "p50 ms", "p95 ms", "p99 ms", "queries"))
+    for endpoint in ("getPurchasables", "getPurchasable", "authenticate", "waitingRoom", "addToCart", "getCart", "checkout"):
+        values = sorted(latencies[endpoint])
+        if not values:
+            continue
+        print("{:<16}{:>8}{:>10.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>11.1f}  {}".format(
+            endpoint, len(values), len(values) / elapsed, 1000 * percentile(values, 0.5), 1000 * percentile(values, 0.95),
+            1000 * percentile(values, 0.99), queryCounts[endpoint] / len(values),
+            ", ".join("{}: {}".format(status, count) for status, count in sorted(statuses[endpoint].items(), key=str))))
+    if statuses.get("scenario"):
+        print("scenario errors: {}".format(dict(statuses["scenario"])))
+
+    with app.app_context():
+        print("\n{:<16}{:>10}{:>8}{:>9}".format("inventory", "capacity", "sold", "counter"))
+        oversells = 0
+        for name, capacity, sold, counter in oversold(purchasableId, eventIds):
+            print("{:<16}{:>10}{:>8}{:>9}".format(name, capacity, sold, counter))
+            oversells += max(0, sold - capacity) + (sold != counter)
+        # deliver the queued confirmations through the suppressed mail backend
+        delivered = 0
+        while True:
+            claimed = folda.processOutbox()
+            if not claimed:
+                break
+            delivered += claimed
+        print("confirmations delivered: {}".format(delivered))
+    print("oversold or miscounted: {}".format(oversells))
+    return 1 if oversells else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+"""add hot query indexes
+
+Revision ID: 1a6f4b8d2e57
+Revises: e15b0d93c6a4
+Create Date: 2026-10-18 14:02:41.660318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1a6f4b8d2e57'
+down_revision = 'e15b0d93c6a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_Ticket_user_id_isPurchased', 'Ticket', ['user_id', 'isPurchased'], unique=False)
+    op.create_index('ix_Ticket_holdExpiresAt_held', 'Ticket', ['holdExpiresAt'], unique=False,
+                    postgresql_where=sa.text('NOT "isPurchased"'))
+    op.create_index('ix_Ticket_purchasable_id_holdExpiresAt_held', 'Ticket', ['purchasable_id', 'holdExpiresAt'], unique=False,
+                    postgresql_where=sa.text('NOT "isPurchased"'))
+    op.create_index('ix_Ticket_order_id', 'Ticket', ['order_id'], unique=False)
+    op.create_index('ix_Event_Ticket_ticket_id', 'Event_Ticket', ['ticket_id'], unique=False)
+    op.create_index('ix_Event_Ticket_event_id', 'Event_Ticket', ['event_id'], unique=False)
+    op.create_index('ix_Event_purchasable_id', 'Event', ['purchasable_id'], unique=False)
+    op.create_index('ix_Purchasable_type', 'Purchasable', ['type'], unique=False)
+    op.create_index('ix_Purchasable_TicketClass_purchasable_id_ticketClass_id', 'Purchasable_TicketClass',
+                    ['purchasable_id', 'ticketClass_id'], unique=False)
+    op.create_index('ix_Outbox_nextAttemptDate_pending', 'Outbox', ['nextAttemptDate'], unique=False,
+                    postgresql_where=sa.text("status = 'pending'"))
+
+
+def downgrade():
+    op.drop_index('ix_Outbox_nextAttemptDate_pending', table_name='Outbox')
+    op.drop_index('ix_Purchasable_TicketClass_purchasable_id_ticketClass_id', table_name='Purchasable_TicketClass')
+    op.drop_index('ix_Purchasable_type', table_name='Purchasable')
+    op.drop_index('ix_Event_purchasable_id', table_name='Event')
+    op.drop_index('ix_Event_Ticket_event_id', table_name='Event_Ticket')
+    op.drop_index('ix_Event_Ticket_ticket_id', table_name='Event_Ticket')
+    op.drop_index('ix_Ticket_order_id', table_name='Ticket')
+    op.drop_index('ix_Ticket_purchasable_id_holdExpiresAt_held', table_name='Ticket')
+    op.drop_index('ix_Ticket_holdExpiresAt_held', table_name='Ticket')
+    op.drop_index('ix_Ticket_user_id_isPurchased', table_name='Ticket')
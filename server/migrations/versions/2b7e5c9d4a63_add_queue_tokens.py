@@ -0,0 +1,37 @@
+"""add waiting room queue tokens
+
+Revision ID: 2b7e5c9d4a63
+Revises: f3a9d2c6e871
+Create Date: 2026-10-18 17:48:30.125904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7e5c9d4a63'
+down_revision = 'f3a9d2c6e871'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('QueueToken',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('issueDate', sa.DateTime(), nullable=False),
+    sa.Column('admitAt', sa.DateTime(), nullable=False),
+    sa.Column('expiresAt', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['User.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('id')
+    )
+    op.create_index('ix_QueueToken_user_id_expiresAt', 'QueueToken', ['user_id', 'expiresAt'], unique=False)
+    op.create_index('ix_QueueToken_admitAt', 'QueueToken', ['admitAt'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_QueueToken_admitAt', table_name='QueueToken')
+    op.drop_index('ix_QueueToken_user_id_expiresAt', table_name='QueueToken')
+    op.drop_table('QueueToken')
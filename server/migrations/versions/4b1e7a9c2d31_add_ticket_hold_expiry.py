@@ -0,0 +1,31 @@
+"""add ticket hold expiry
+
+Revision ID: 4b1e7a9c2d31
+Revises: d172c640b610
+Create Date: 2026-10-18 09:12:40.418233
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from datetime import datetime, timedelta
+from os import environ
+
+
+# revision identifiers, used by Alembic.
+revision = '4b1e7a9c2d31'
+down_revision = 'd172c640b610'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Ticket', sa.Column('holdExpiresAt', sa.DateTime(), nullable=True))
+    # carts from before the upgrade get one hold window from now, after which
+    # release-holds gives their capacity back like any other lapsed hold
+    ticket = sa.table('Ticket', sa.column('isPurchased', sa.Boolean), sa.column('holdExpiresAt', sa.DateTime))
+    holdExpiresAt = datetime.utcnow() + timedelta(minutes=int(environ.get('CART_HOLD_MINUTES', 15)))
+    op.execute(ticket.update().where(ticket.c.isPurchased == False).values(holdExpiresAt=holdExpiresAt))
+
+
+def downgrade():
+    op.drop_column('Ticket', 'holdExpiresAt')
@@ -0,0 +1,100 @@
+"""add hourly sales rollups
+
+Revision ID: 5d2e8b7c4f19
+Revises: 1a6f4b8d2e57
+Create Date: 2026-10-18 15:10:07.214533
+
+"""
+from collections import defaultdict
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d2e8b7c4f19'
+down_revision = '1a6f4b8d2e57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('SalesRollup',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('hour', sa.DateTime(), nullable=False),
+    sa.Column('purchasable_id', sa.Integer(), nullable=False),
+    sa.Column('ticketClass_id', sa.Integer(), nullable=False),
+    sa.Column('event_id', sa.Integer(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.Column('grossCents', sa.Integer(), nullable=False),
+    sa.Column('taxCents', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['purchasable_id'], ['Purchasable.id'], ),
+    sa.ForeignKeyConstraint(['ticketClass_id'], ['TicketClass.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('hour', 'purchasable_id', 'ticketClass_id', 'event_id', name='uq_SalesRollup_bucket'),
+    sa.UniqueConstraint('id')
+    )
+
+    # backfill from existing orders the same way checkout rolls them up:
+    # sale rows under event_id 0, admissions per event, and each order's
+    # tax spread over its lines with the remainder on the first line
+    order = sa.table('Order', sa.column('id', sa.Integer), sa.column('taxCents', sa.Integer))
+    ticket = sa.table('Ticket', sa.column('id', sa.Integer), sa.column('order_id', sa.Integer),
+                      sa.column('purchaseDate', sa.DateTime), sa.column('purchasable_id', sa.Integer),
+                      sa.column('ticketClass_id', sa.Integer))
+    ticketClass = sa.table('TicketClass', sa.column('id', sa.Integer), sa.column('priceCents', sa.Integer))
+    eventTicket = sa.table('Event_Ticket', sa.column('event_id', sa.Integer), sa.column('ticket_id', sa.Integer))
+    rollup = sa.table('SalesRollup', sa.column('hour', sa.DateTime), sa.column('purchasable_id', sa.Integer),
+                      sa.column('ticketClass_id', sa.Integer), sa.column('event_id', sa.Integer),
+                      sa.column('units', sa.Integer), sa.column('grossCents', sa.Integer),
+                      sa.column('taxCents', sa.Integer))
+    connection = op.get_bind()
+
+    lineColumns = [ticket.c.order_id, ticket.c.purchaseDate, ticket.c.purchasable_id, ticket.c.ticketClass_id]
+    priced = ticket.join(ticketClass, ticketClass.c.id == ticket.c.ticketClass_id)
+    lines = connection.execute(sa.select(lineColumns + [
+        sa.func.count(ticket.c.id), sa.func.sum(ticketClass.c.priceCents)]).select_from(priced).where(
+        ticket.c.order_id != None).group_by(*lineColumns).order_by(
+        ticket.c.order_id, ticket.c.purchasable_id, ticket.c.ticketClass_id)).fetchall()
+    taxCents = dict(connection.execute(sa.select([order.c.id, order.c.taxCents])).fetchall())
+
+    subtotals = defaultdict(int)
+    for (orderId, _, _, _, _, grossCents) in lines:
+        subtotals[orderId] += grossCents
+    lineTaxes, allocated, firstLines = {}, defaultdict(int), {}
+    for (orderId, _, purchasableId, ticketClassId, _, grossCents) in lines:
+        line = (orderId, purchasableId, ticketClassId)
+        lineTaxes[line] = (taxCents[orderId] or 0) * grossCents // subtotals[orderId] if subtotals[orderId] else 0
+        allocated[orderId] += lineTaxes[line]
+        firstLines.setdefault(orderId, line)
+    for orderId, line in firstLines.items():
+        lineTaxes[line] += (taxCents[orderId] or 0) - allocated[orderId]
+
+    buckets = defaultdict(lambda: [0, 0, 0])
+    lineUnits = {}
+    for (orderId, purchaseDate, purchasableId, ticketClassId, units, grossCents) in lines:
+        bucket = buckets[(purchaseDate.replace(minute=0, second=0, microsecond=0), purchasableId, ticketClassId, 0)]
+        bucket[0] += units
+        bucket[1] += grossCents
+        bucket[2] += lineTaxes[(orderId, purchasableId, ticketClassId)]
+        lineUnits[(orderId, purchasableId, ticketClassId)] = units
+
+    for (orderId, purchaseDate, purchasableId, ticketClassId, eventId, units, grossCents) in connection.execute(
+            sa.select(lineColumns + [eventTicket.c.event_id, sa.func.count(ticket.c.id), sa.func.sum(ticketClass.c.priceCents)]).select_from(
+            priced.join(eventTicket, eventTicket.c.ticket_id == ticket.c.id)).where(
+            ticket.c.order_id != None).group_by(*(lineColumns + [eventTicket.c.event_id]))):
+        line = (orderId, purchasableId, ticketClassId)
+        bucket = buckets[(purchaseDate.replace(minute=0, second=0, microsecond=0), purchasableId, ticketClassId, eventId)]
+        bucket[0] += units
+        bucket[1] += grossCents
+        bucket[2] += lineTaxes[line] * units // lineUnits[line]
+
+    if buckets:
+        op.bulk_insert(rollup, [{
+            "hour": hour, "purchasable_id": purchasableId, "ticketClass_id": ticketClassId, "event_id": eventId,
+            "units": units, "grossCents": grossCents, "taxCents": bucketTax
+        } for (hour, purchasableId, ticketClassId, eventId), (units, grossCents, bucketTax) in sorted(buckets.items())])
+
+
+def downgrade():
+    op.drop_table('SalesRollup')
@@ -0,0 +1,28 @@
+"""index purchased pages and outbox lookups
+
+Revision ID: 6e0b3d8f5a14
+Revises: 2b7e5c9d4a63
+Create Date: 2026-10-18 21:12:36.508117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e0b3d8f5a14'
+down_revision = '2b7e5c9d4a63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_Ticket_user_id_isPurchased_id', 'Ticket', ['user_id', 'isPurchased', 'id'], unique=False)
+    op.drop_index('ix_Ticket_user_id_isPurchased', table_name='Ticket')
+    op.create_index('ix_Outbox_order_id', 'Outbox', ['order_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_Outbox_order_id', table_name='Outbox')
+    op.create_index('ix_Ticket_user_id_isPurchased', 'Ticket', ['user_id', 'isPurchased'], unique=False)
+    op.drop_index('ix_Ticket_user_id_isPurchased_id', table_name='Ticket')
@@ -0,0 +1,37 @@
+"""add event schedule indexes
+
+Revision ID: 8c4a1f6e3b25
+Revises: 5d2e8b7c4f19
+Create Date: 2026-10-18 16:21:53.408127
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4a1f6e3b25'
+down_revision = '5d2e8b7c4f19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_Event_startTime_id', 'Event', ['startTime', 'id'], unique=False)
+    op.create_index('ix_Event_venue_startTime', 'Event', ['venue', 'startTime'], unique=False)
+    if op.get_bind().dialect.name == 'postgresql':
+        # tsrange() rejects an event that ends before it starts, which would
+        # abort the index build halfway; name the rows to fix instead
+        backwards = [id for (id,) in op.get_bind().execute(
+            'SELECT id FROM "Event" WHERE "endTime" < "startTime" ORDER BY id')]
+        if backwards:
+            raise RuntimeError("events {} end before they start; correct their times and rerun the upgrade".format(
+                ", ".join(str(id) for id in backwards)))
+        op.execute('CREATE INDEX "ix_Event_schedule" ON "Event" USING gist (tsrange("startTime", "endTime"))')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_Event_schedule', table_name='Event')
+    op.drop_index('ix_Event_venue_startTime', table_name='Event')
+    op.drop_index('ix_Event_startTime_id', table_name='Event')
@@ -0,0 +1,54 @@
+"""add order and outbox
+
+Revision ID: 9e3c5f0a7b12
+Revises: 4b1e7a9c2d31
+Create Date: 2026-10-18 10:03:17.905114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e3c5f0a7b12'
+down_revision = '4b1e7a9c2d31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Order',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('createDate', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('totalPrice', sa.Float(), nullable=False),
+    sa.Column('paymentId', sa.String(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['User.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('id')
+    )
+    op.create_table('Outbox',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('kind', sa.String(), nullable=False),
+    sa.Column('payload', sa.Text(), nullable=False),
+    sa.Column('status', sa.Enum('pending', 'sent', 'failed', name='outboxstatus'), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('lastError', sa.String(), nullable=True),
+    sa.Column('createDate', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('nextAttemptDate', sa.DateTime(), nullable=False),
+    sa.Column('sentDate', sa.DateTime(), nullable=True),
+    sa.Column('order_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['order_id'], ['Order.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('id')
+    )
+    op.add_column('Ticket', sa.Column('order_id', sa.Integer(), nullable=True))
+    op.create_foreign_key(None, 'Ticket', 'Order', ['order_id'], ['id'])
+
+
+def downgrade():
+    op.drop_constraint('Ticket_order_id_fkey', 'Ticket', type_='foreignkey')
+    op.drop_column('Ticket', 'order_id')
+    op.drop_table('Outbox')
+    op.drop_table('Order')
+    sa.Enum(name='outboxstatus').drop(op.get_bind(), checkfirst=False)
@@ -0,0 +1,42 @@
+"""add inventory counters
+
+Revision ID: c7d28e4f1a90
+Revises: 9e3c5f0a7b12
+Create Date: 2026-10-18 11:26:52.331877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d28e4f1a90'
+down_revision = '9e3c5f0a7b12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('Purchasable', 'Event'):
+        op.add_column(table, sa.Column('soldCount', sa.Integer(), server_default='0', nullable=False))
+        op.add_column(table, sa.Column('heldCount', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill from the tickets that already exist
+    op.execute("""
+        UPDATE "Purchasable" SET
+            "soldCount" = (SELECT count(*) FROM "Ticket" WHERE "Ticket".purchasable_id = "Purchasable".id AND "Ticket"."isPurchased"),
+            "heldCount" = (SELECT count(*) FROM "Ticket" WHERE "Ticket".purchasable_id = "Purchasable".id AND NOT "Ticket"."isPurchased")
+    """)
+    op.execute("""
+        UPDATE "Event" SET
+            "soldCount" = (SELECT count(*) FROM "Event_Ticket" JOIN "Ticket" ON "Ticket".id = "Event_Ticket".ticket_id
+                           WHERE "Event_Ticket".event_id = "Event".id AND "Ticket"."isPurchased"),
+            "heldCount" = (SELECT count(*) FROM "Event_Ticket" JOIN "Ticket" ON "Ticket".id = "Event_Ticket".ticket_id
+                           WHERE "Event_Ticket".event_id = "Event".id AND NOT "Ticket"."isPurchased")
+    """)
+
+
+def downgrade():
+    for table in ('Event', 'Purchasable'):
+        op.drop_column(table, 'heldCount')
+        op.drop_column(table, 'soldCount')
@@ -0,0 +1,47 @@
+"""store prices in cents
+
+Revision ID: e15b0d93c6a4
+Revises: c7d28e4f1a90
+Create Date: 2026-10-18 12:48:05.117629
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e15b0d93c6a4'
+down_revision = 'c7d28e4f1a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('TicketClass', sa.Column('priceCents', sa.Integer(), nullable=True))
+    op.execute('UPDATE "TicketClass" SET "priceCents" = ROUND(price * 100)')
+    op.alter_column('TicketClass', 'priceCents', nullable=False)
+    op.drop_column('TicketClass', 'price')
+
+    op.add_column('Order', sa.Column('subtotalCents', sa.Integer(), nullable=True))
+    op.add_column('Order', sa.Column('taxCents', sa.Integer(), nullable=True))
+    op.add_column('Order', sa.Column('totalCents', sa.Integer(), nullable=True))
+    # earlier orders only kept the total; split it back out at the 13% rate
+    op.execute('UPDATE "Order" SET "totalCents" = ROUND("totalPrice" * 100), "subtotalCents" = ROUND("totalPrice" * 100 / 1.13)')
+    op.execute('UPDATE "Order" SET "taxCents" = "totalCents" - "subtotalCents"')
+    for column in ('subtotalCents', 'taxCents', 'totalCents'):
+        op.alter_column('Order', column, nullable=False)
+    op.drop_column('Order', 'totalPrice')
+
+
+def downgrade():
+    op.add_column('Order', sa.Column('totalPrice', sa.Float(), nullable=True))
+    op.execute('UPDATE "Order" SET "totalPrice" = "totalCents" / 100.0')
+    op.alter_column('Order', 'totalPrice', nullable=False)
+    op.drop_column('Order', 'totalCents')
+    op.drop_column('Order', 'taxCents')
+    op.drop_column('Order', 'subtotalCents')
+
+    op.add_column('TicketClass', sa.Column('price', sa.Float(), nullable=True))
+    op.execute('UPDATE "TicketClass" SET price = "priceCents" / 100.0')
+    op.alter_column('TicketClass', 'price', nullable=False)
+    op.drop_column('TicketClass', 'priceCents')
@@ -0,0 +1,35 @@
+"""add full-text search indexes
+
+Revision ID: f3a9d2c6e871
+Revises: 8c4a1f6e3b25
+Create Date: 2026-10-18 17:05:12.933410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a9d2c6e871'
+down_revision = '8c4a1f6e3b25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Postgres only; must stay identical to searchVectorSql in src/app.py
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE INDEX "ix_Event_search" ON "Event" USING gin (('
+               "setweight(to_tsvector('simple', coalesce(\"name\", '') || ' ' || coalesce(\"artistName\", '')), 'A') || "
+               "setweight(to_tsvector('simple', coalesce(\"description\", '')), 'C')))")
+    op.execute('CREATE INDEX "ix_Purchasable_search" ON "Purchasable" USING gin (('
+               "setweight(to_tsvector('simple', coalesce(\"name\", '')), 'A') || "
+               "setweight(to_tsvector('simple', coalesce(\"description\", '')), 'C')))")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_Purchasable_search', table_name='Purchasable')
+    op.drop_index('ix_Event_search', table_name='Event')
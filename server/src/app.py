@@ -1,100 +1,234 @@
-from flask import Flask, request, jsonify, abort
+from flask import Blueprint, Flask, request, abort, current_app, g, has_request_context, stream_with_context
 from flask_mail import Mail, Message
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from sqlathanor import FlaskBaseModel, initialize_flask_sqlathanor
-from flask_migrate import Migrate
 from flask_jwt_extended import (
     JWTManager, jwt_required, create_access_token,
     get_jwt_identity
 )
 import enum
 import bcrypt
+import bisect
+import click
+import csv
+import io
+import json
+import operator
+import orjson
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from flask_cors import CORS
-from square.client import Client
+from sqlalchemy.dialects.postgresql import insert as postgresInsert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool, Pool
 from os import urandom, environ
 from base64 import b64encode
-from math import ceil
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from datetime import date, datetime, timedelta, timezone
 from dotenv import load_dotenv
+from werkzeug.urls import url_encode
+from werkzeug.http import http_date, parse_date
 
 load_dotenv()
-SQUARE_TOKEN = environ['SQUARE_TOKEN']
-SQUARE_ENVIRONMENT = environ['SQUARE_ENVIRONMENT']
-DEBUG_ENABLED = environ['DEBUG_ENABLED']
-JWT_SECRET_KEY = environ['JWT_SECRET_KEY']
-SQLALCHEMY_DATABASE_URI = environ['SQLALCHEMY_DATABASE_URI']
-
-square = Client(
-    access_token=SQUARE_TOKEN,
-    environment=SQUARE_ENVIRONMENT)
-
-app = Flask(__name__)
-
-app.config['DEBUG'] = DEBUG_ENABLED == "yes"
-app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
-
-app.config['JWT_SECRET_KEY'] = JWT_SECRET_KEY
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = False
-
-CORS(app)
-
-jwt = JWTManager(app)
-
-SQLALCHEMY_TRACK_MODIFICATIONS = True
-db = SQLAlchemy(app, model_class=FlaskBaseModel)
+REPLICA_STICKY_SECONDS = float(environ.get('REPLICA_STICKY_SECONDS', 5))  # covers replica lag after a write
+CART_HOLD_MINUTES = int(environ.get('CART_HOLD_MINUTES', 15))
+OUTBOX_MAX_ATTEMPTS = int(environ.get('OUTBOX_MAX_ATTEMPTS', 8))
+MAIL_MAX_PER_SECOND = float(environ.get('MAIL_MAX_PER_SECOND', 10))
+TAX_RATE_BASIS_POINTS = int(environ.get('TAX_RATE_BASIS_POINTS', 1300))  # 13% HST
+CATALOG_CACHE_SIZE = int(environ.get('CATALOG_CACHE_SIZE', 256))
+CATALOG_GENERATION_FILE = environ.get('CATALOG_GENERATION_FILE', os.path.join(
+    tempfile.gettempdir(), 'folda-catalog-generation'))
+EXPORT_CHUNK_SIZE = int(environ.get('EXPORT_CHUNK_SIZE', 1000))
+IMPORT_BATCH_SIZE = int(environ.get('IMPORT_BATCH_SIZE', 500))
+SLOW_REQUEST_MS = float(environ.get('SLOW_REQUEST_MS', 500))
+SQL_DEBUG = environ.get('SQL_DEBUG') == "yes"  # log statements repeated within one request
+SQL_REPEAT_THRESHOLD = int(environ.get('SQL_REPEAT_THRESHOLD', 5))
+METRICS_TOKEN = environ.get('METRICS_TOKEN')
+MAX_PAGE_SIZE = int(environ.get('MAX_PAGE_SIZE', 500))
+PASSWORD_HASH_ROUNDS = int(environ.get('PASSWORD_HASH_ROUNDS', 12))
+PASSWORD_WORKERS = int(environ.get('PASSWORD_WORKERS', os.cpu_count() or 1))
+PASSWORD_QUEUE_DEPTH = int(environ.get('PASSWORD_QUEUE_DEPTH', 4 * PASSWORD_WORKERS))
+PASSWORD_RETRY_AFTER = int(environ.get('PASSWORD_RETRY_AFTER', 1))
+WAITING_ROOM_RATE = float(environ.get('WAITING_ROOM_RATE', 0))  # admissions per second; 0 leaves the cart open
+WAITING_ROOM_WINDOW_MINUTES = int(environ.get('WAITING_ROOM_WINDOW_MINUTES', CART_HOLD_MINUTES))
+WAITING_ROOM_POLL_SECONDS = int(environ.get('WAITING_ROOM_POLL_SECONDS', 5))
+
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        # requests marked by cachedCatalog read from the replica until they write
+        if hasReplica() and has_request_context() and g.get('useReplica') and not (
+                self._flushing or self.new or self.dirty or self.deleted):
+            return self.db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def hasReplica():
+    return 'replica' in (current_app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+db = RoutingSQLAlchemy(model_class=FlaskBaseModel)
 db = initialize_flask_sqlathanor(db)
+jwt = JWTManager()
+mail = Mail()
+api = Blueprint('api', __name__, cli_group=None)
+
+
+def getSquare():
+    # built on first payment; the SDK is slow to import and most workers
+    # serve catalog traffic long before anyone checks out
+    client = current_app.extensions.get('square')
+    if client is None:
+        from square.client import Client
+        client = current_app.extensions['square'] = Client(
+            access_token=current_app.config['SQUARE_TOKEN'],
+            environment=current_app.config['SQUARE_ENVIRONMENT'])
+    return client
+
+
+@db.event.listens_for(Pool, 'connect')
+def rememberConnectionPid(dbapiConnection, connectionRecord):
+    connectionRecord.info['pid'] = os.getpid()
+
+
+@db.event.listens_for(Pool, 'checkout')
+def discardForkedConnection(dbapiConnection, connectionRecord, connectionProxy):
+    # a pool inherited through fork (gunicorn --preload) must not share the
+    # parent's sockets; the pool replaces the connection with a fresh one
+    if connectionRecord.info['pid'] != os.getpid():
+        connectionRecord.connection = connectionProxy.connection = None
+        raise DisconnectionError("Connection belongs to pid {}, checked out in pid {}".format(
+            connectionRecord.info['pid'], os.getpid()))
+
+
+def defaultConfig():
+    config = {
+        'DEBUG': environ.get('DEBUG_ENABLED') == "yes",
+        'TESTING': False,
+        'SQUARE_TOKEN': environ.get('SQUARE_TOKEN'),
+        'SQUARE_ENVIRONMENT': environ.get('SQUARE_ENVIRONMENT'),
+        'SQLALCHEMY_DATABASE_URI': environ.get('SQLALCHEMY_DATABASE_URI'),
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'JWT_SECRET_KEY': environ.get('JWT_SECRET_KEY'),
+        'JWT_ACCESS_TOKEN_EXPIRES': False,
+        #email config
+        'MAIL_SERVER': environ.get('MAIL_SERVER', 'smtp.gmail.com'),
+        'MAIL_PORT': int(environ.get('MAIL_PORT', 465)),
+        'MAIL_USE_TLS': False,
+        'MAIL_USE_SSL': environ.get('MAIL_USE_SSL', 'yes') == "yes",
+        'MAIL_USERNAME': 'foldaconfirmation@gmail.com',
+        'MAIL_PASSWORD': 'folda2020',
+        'MAIL_DEFAULT_SENDER': ('FoldA Festival of Live Digital Art','foldaconfirmation@gmail.com'),
+        'MAIL_MAX_EMAILS': 1000,  # reconnect after this many messages on one connection
+        # "yes" records messages instead of sending them (see mail.record_messages)
+        'MAIL_SUPPRESS_SEND': environ.get('MAIL_SUPPRESS_SEND') == "yes",
+        'MAIL_ASCII_ATTACHMENTS': False
+    }
+    if environ.get('REPLICA_DATABASE_URI'):  # catalog reads go here when set
+        config['SQLALCHEMY_BINDS'] = {'replica': environ['REPLICA_DATABASE_URI']}
+    if environ.get('DATABASE_PGBOUNCER') == "yes":
+        # let PgBouncer own the pool; nothing session-level survives transaction pooling anyway
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = {'poolclass': NullPool}
+    elif not (config['SQLALCHEMY_DATABASE_URI'] or '').startswith('sqlite'):
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': int(environ.get('DATABASE_POOL_SIZE', 5)),
+            'max_overflow': int(environ.get('DATABASE_MAX_OVERFLOW', 10)),
+            'pool_recycle': int(environ.get('DATABASE_POOL_RECYCLE', 1800)),
+            'pool_pre_ping': environ.get('DATABASE_POOL_PRE_PING', 'yes') == "yes"
+        }
+    return config
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(defaultConfig())
+    app.config.update(config or {})
+    missing = [key for key in ('SQUARE_TOKEN', 'SQUARE_ENVIRONMENT', 'SQLALCHEMY_DATABASE_URI', 'JWT_SECRET_KEY')
+               if not app.config.get(key)]
+    if missing:
+        raise RuntimeError("Missing configuration: {}".format(", ".join(missing)))
+
+    CORS(app)
+    jwt.init_app(app)
+    db.init_app(app)  # engines are created on first use
+    mail.init_app(app)
+    if 'flask_migrate' in sys.modules:
+        # only the flask CLI loads Flask-Migrate (for `flask db`); web workers
+        # skip importing alembic altogether
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    app.register_blueprint(api)
+    return app
 
-migrate = Migrate(app, db)
-
-#email config
-app.config['DEBUG'] = True
-app.config['TESTING'] = False
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 465
-app.config['MAIL_USE_TLS'] = False
-app.config['MAIL_USE_SSL'] = True
-#app.config['MAIL_DEBUG'] = True
-app.config['MAIL_USERNAME'] = 'foldaconfirmation@gmail.com'
-app.config['MAIL_PASSWORD'] = 'folda2020'
-app.config['MAIL_DEFAULT_SENDER'] = ('FoldA Festival of Live Digital Art','foldaconfirmation@gmail.com')
-app.config['MAIL_MAX_EappS'] = 1000
-#app.config['MAIL_SUPPRESS_SEND'] = False
-app.config['MAIL_ASCII_ATTACHMENTS'] = False
-mail = Mail(app)
 
 class Event_Ticket(db.Model):
     __tablename__ = 'Event_Ticket'
+    __table_args__ = (
+        db.Index('ix_Event_Ticket_ticket_id', 'ticket_id'),
+        db.Index('ix_Event_Ticket_event_id', 'event_id'),
+    )
     id = db.Column(db.Integer, primary_key=True,
                    autoincrement=True, nullable=False, unique=True)
 
     event_id = db.Column(db.Integer, db.ForeignKey(
         'Event.id', ondelete='CASCADE'), nullable=False)
     event = db.relationship(
-        'Event', backref='Event_Ticket', lazy="joined")
+        'Event', backref='Event_Ticket')
 
     ticket_id = db.Column(db.Integer, db.ForeignKey(
         'Ticket.id', ondelete='CASCADE'), nullable=False)
     ticket = db.relationship(
-        'Ticket', backref='Event_Ticket', lazy="joined")
+        'Ticket', backref='Event_Ticket')
 
 
 class Purchasable_TicketClass(db.Model):
     __tablename__ = 'Purchasable_TicketClass'
+    __table_args__ = (
+        db.Index('ix_Purchasable_TicketClass_purchasable_id_ticketClass_id',
+                 'purchasable_id', 'ticketClass_id'),
+    )
     id = db.Column(db.Integer, primary_key=True,
                    autoincrement=True, nullable=False, unique=True)
 
     purchasable_id = db.Column(db.Integer, db.ForeignKey(
         'Purchasable.id'), nullable=False)
     purchasable = db.relationship(
-        'Purchasable', backref='Purchasable_TicketClass', lazy="joined")
+        'Purchasable', backref='Purchasable_TicketClass')
 
     ticketClass_id = db.Column(db.Integer, db.ForeignKey(
         'TicketClass.id'), nullable=False)
     ticketClass = db.relationship(
-        'TicketClass', backref='Purchasable_TicketClass', lazy="joined")
+        'TicketClass', backref='Purchasable_TicketClass')
 
 
 class Event(db.Model):
     __tablename__ = 'Event'
+    __table_args__ = (
+        db.Index('ix_Event_purchasable_id', 'purchasable_id'),
+        db.Index('ix_Event_startTime_id', 'startTime', 'id'),
+        db.Index('ix_Event_venue_startTime', 'venue', 'startTime'),
+    )
     id = db.Column(db.Integer, primary_key=True,
                    autoincrement=True, nullable=False, unique=True)
     artistName = db.Column(db.String)
@@ -107,11 +241,19 @@ class Event(db.Model):
     capacity = db.Column(db.Integer)
     isFull = db.Column(db.Boolean, nullable=False, default=False)
     name = db.Column(db.String, nullable=False)
+    soldCount = db.Column(db.Integer, nullable=False, default=0)
+    heldCount = db.Column(db.Integer, nullable=False, default=0)
 
     purchasable_id = db.Column(db.Integer, db.ForeignKey(
         'Purchasable.id'), nullable=False)
     purchasable = db.relationship(
-        'Purchasable', backref='Event', lazy="joined")
+        'Purchasable', backref='Event')
+
+
+# time windows are range overlaps, served on Postgres by a GiST index over
+# each event's [startTime, endTime) range; see eventsOverlapping
+db.event.listen(Event.__table__, 'after_create', db.DDL(
+    'CREATE INDEX "ix_Event_schedule" ON "Event" USING gist (tsrange("startTime", "endTime"))').execute_if(dialect='postgresql'))
 
 
 class PurchasableTypes2(enum.Enum):
@@ -121,6 +263,9 @@ class PurchasableTypes2(enum.Enum):
 
 class Purchasable(db.Model):
     __tablename__ = 'Purchasable'
+    __table_args__ = (
+        db.Index('ix_Purchasable_type', 'type'),
+    )
     id = db.Column(db.Integer, primary_key=True,
                    autoincrement=True, nullable=False, unique=True)
 
@@ -129,25 +274,38 @@ class Purchasable(db.Model):
     type = db.Column(db.Enum(PurchasableTypes2), nullable=False)
     numTickets = db.Column(db.Integer, nullable=False)
     isSoldOut = db.Column(db.Boolean, nullable=False, default=False)
+    soldCount = db.Column(db.Integer, nullable=False, default=0)
+    heldCount = db.Column(db.Integer, nullable=False, default=0)
 
     events = db.relationship(
-        'Event', backref='Purchasable', lazy="joined")
+        'Event', backref='Purchasable')
 
+    # these grow with sales; query Ticket directly instead of loading them
     tickets = db.relationship(
-        'Ticket', backref='Purchasable', lazy="joined")
+        'Ticket', backref='Purchasable', lazy="raise")
 
     purchasedTickets = db.relationship(
-        'Ticket', lazy="joined", primaryjoin="and_(Purchasable.id==Ticket.purchasable_id, Ticket.isPurchased==True)")
+        'Ticket', lazy="raise", primaryjoin="and_(Purchasable.id==Ticket.purchasable_id, Ticket.isPurchased==True)")
 
     unpurchasedTickets = db.relationship(
-        'Ticket', lazy="joined", primaryjoin="and_(Purchasable.id==Ticket.purchasable_id, Ticket.isPurchased==False)")
+        'Ticket', lazy="raise", primaryjoin="and_(Purchasable.id==Ticket.purchasable_id, Ticket.isPurchased==False)")
 
     ticketClasses = db.relationship(
-        'Purchasable_TicketClass', backref='Purchasable', lazy="joined")
+        'Purchasable_TicketClass', backref='Purchasable')
 
 
 class Ticket(db.Model):
     __tablename__ = 'Ticket'
+    __table_args__ = (
+        # carts, purchased lists and checkout; id keeps pages in index order
+        db.Index('ix_Ticket_user_id_isPurchased_id', 'user_id', 'isPurchased', 'id'),
+        # the hold sweeper, only over tickets still in a cart
+        db.Index('ix_Ticket_holdExpiresAt_held', 'holdExpiresAt',
+                 postgresql_where=db.text('NOT "isPurchased"')),
+        db.Index('ix_Ticket_purchasable_id_holdExpiresAt_held', 'purchasable_id', 'holdExpiresAt',
+                 postgresql_where=db.text('NOT "isPurchased"')),
+        db.Index('ix_Ticket_order_id', 'order_id'),
+    )
     id = db.Column(db.Integer, primary_key=True,
                    autoincrement=True, nullable=False, unique=True)
     isPurchased = db.Column(db.Boolean, nullable=False, default=False)
@@ -155,6 +313,7 @@ class Ticket(db.Model):
         db.DateTime, server_default=db.func.now(), nullable=False)
 
     purchaseDate = db.Column(db.DateTime)
+    holdExpiresAt = db.Column(db.DateTime)
 
     purchasable_id = db.Column(db.Integer, db.ForeignKey(
         'Purchasable.id'), nullable=False)
@@ -169,8 +328,10 @@ class Ticket(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('User.id'), nullable=False)
     user = db.relationship('User', backref='Ticket')
 
+    order_id = db.Column(db.Integer, db.ForeignKey('Order.id'))
+
     events = db.relationship(
-        'Event_Ticket', backref='Ticket', lazy="joined")
+        'Event_Ticket', backref='Ticket')
 
 
 class TicketClass(db.Model):
@@ -178,7 +339,7 @@ class TicketClass(db.Model):
     id = db.Column(db.Integer, primary_key=True,
                    autoincrement=True, nullable=False, unique=True)
     description = db.Column(db.String, nullable=False)
-    price = db.Column(db.Float, nullable=False)
+    priceCents = db.Column(db.Integer, nullable=False)
 
     tickets = db.relationship(
         'Ticket', backref='TicketClass')
@@ -186,6 +347,10 @@ class TicketClass(db.Model):
     purchasables = db.relationship(
         'Purchasable_TicketClass', backref='TicketClass')
 
+    @property
+    def price(self):
+        return toDollars(self.priceCents)
+
 
 class User(db.Model):
     __tablename__ = 'User'
@@ -207,30 +372,507 @@ class User(db.Model):
         'Ticket', backref='User')
 
 
+class Order(db.Model):
+    __tablename__ = 'Order'
+    id = db.Column(db.Integer, primary_key=True,
+                   autoincrement=True, nullable=False, unique=True)
+    createDate = db.Column(
+        db.DateTime, server_default=db.func.now(), nullable=False)
+    subtotalCents = db.Column(db.Integer, nullable=False)
+    taxCents = db.Column(db.Integer, nullable=False)
+    totalCents = db.Column(db.Integer, nullable=False)
+    paymentId = db.Column(db.String)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('User.id'), nullable=False)
+
+    tickets = db.relationship('Ticket', backref='Order')
+
 
-def serialize(obj):
-    result = {c.key: getattr(obj, c.key)
-              for c in db.inspect(obj).mapper.column_attrs}
-    result.pop("password", None)  # remove password if exists
-    for key in result:  # convert enums to strings
-        if isinstance(result[key], enum.Enum):
-            result[key] = str(result[key]).split('.')[-1]
+class OutboxStatus(enum.Enum):
+    pending = 0
+    sent = 1
+    failed = 2
+
+
+class Outbox(db.Model):
+    __tablename__ = 'Outbox'
+    __table_args__ = (
+        db.Index('ix_Outbox_nextAttemptDate_pending', 'nextAttemptDate',
+                 postgresql_where=db.text("status = 'pending'")),
+        db.Index('ix_Outbox_order_id', 'order_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True,
+                   autoincrement=True, nullable=False, unique=True)
+    kind = db.Column(db.String, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Enum(OutboxStatus), nullable=False,
+                       default=OutboxStatus.pending)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    lastError = db.Column(db.String)
+    createDate = db.Column(
+        db.DateTime, server_default=db.func.now(), nullable=False)
+    nextAttemptDate = db.Column(
+        db.DateTime, default=datetime.utcnow, nullable=False)
+    sentDate = db.Column(db.DateTime)
+
+    order_id = db.Column(db.Integer, db.ForeignKey('Order.id'))
+    order = db.relationship('Order', backref='outbox')
+
+
+class SalesRollup(db.Model):
+    # hourly sales per purchasable and ticket class. Rows with event_id 0 are
+    # the sales themselves; rows for an event count the tickets admitting to
+    # it, so those overlap and must not be summed across events
+    __tablename__ = 'SalesRollup'
+    __table_args__ = (
+        db.UniqueConstraint('hour', 'purchasable_id', 'ticketClass_id', 'event_id',
+                            name='uq_SalesRollup_bucket'),
+    )
+    id = db.Column(db.Integer, primary_key=True,
+                   autoincrement=True, nullable=False, unique=True)
+    hour = db.Column(db.DateTime, nullable=False)
+    purchasable_id = db.Column(db.Integer, db.ForeignKey(
+        'Purchasable.id'), nullable=False)
+    ticketClass_id = db.Column(db.Integer, db.ForeignKey(
+        'TicketClass.id'), nullable=False)
+    event_id = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    grossCents = db.Column(db.Integer, nullable=False, default=0)
+    taxCents = db.Column(db.Integer, nullable=False, default=0)
+
+
+class QueueToken(db.Model):
+    # a place in the waiting room; the holder may use the cart and checkout
+    # from admitAt until expiresAt
+    __tablename__ = 'QueueToken'
+    __table_args__ = (
+        db.Index('ix_QueueToken_user_id_expiresAt', 'user_id', 'expiresAt'),
+        db.Index('ix_QueueToken_admitAt', 'admitAt'),
+    )
+    id = db.Column(db.Integer, primary_key=True,
+                   autoincrement=True, nullable=False, unique=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('User.id'), nullable=False)
+    issueDate = db.Column(db.DateTime, nullable=False)
+    admitAt = db.Column(db.DateTime, nullable=False)
+    expiresAt = db.Column(db.DateTime, nullable=False)
+
+
+# Loading profiles
+#   Relationships load lazily by default, so every query states what its
+#   endpoint serializes: catalog listings need a purchasable's events, admin
+#   views add its ticket classes, carts need each ticket's class and events.
+purchasableEvents = db.selectinload(Purchasable.events)
+purchasableTicketClasses = db.selectinload(
+    Purchasable.ticketClasses).joinedload(Purchasable_TicketClass.ticketClass)
+
+catalogProfile = [purchasableEvents]
+adminProfile = [purchasableEvents, purchasableTicketClasses]
+cartProfile = [db.joinedload(Ticket.ticketClass), db.selectinload(
+    Ticket.events).joinedload(Event_Ticket.event)]
+
+
+# Pricing
+#   Money is kept in integer cents. A cart is priced with one GROUP BY over its
+#   tickets, giving a line per purchasable and ticket class; tax is charged on
+#   the subtotal and rounded up to the cent.
+def toCents(dollars):
+    return int((Decimal(str(dollars)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def toDollars(cents):
+    return cents / 100.0
+
+
+def priceTickets(userId, isPurchased=False, ticketIds=None):
+    lines = db.session.query(Ticket.purchasable_id, Ticket.ticketClass_id, TicketClass.description, TicketClass.priceCents,
+                             db.func.count(Ticket.id), db.func.sum(TicketClass.priceCents)).join(
+        TicketClass, TicketClass.id == Ticket.ticketClass_id).filter(
+        Ticket.user_id == userId, Ticket.isPurchased == isPurchased)
+    if ticketIds is not None:
+        lines = lines.filter(Ticket.id.in_(ticketIds))
+    lines = lines.group_by(
+        Ticket.purchasable_id, Ticket.ticketClass_id, TicketClass.description, TicketClass.priceCents).order_by(
+        Ticket.purchasable_id, Ticket.ticketClass_id).all()
+
+    subtotalCents = sum(lineCents for (_, _, _, _, _, lineCents) in lines)
+    taxCents = -(-subtotalCents * TAX_RATE_BASIS_POINTS // 10000)
+    return {
+        "lineItems": [{"purchasableId": purchasableId, "ticketClassId": ticketClassId, "description": description,
+                       "quantity": quantity, "unitPriceCents": unitPriceCents, "totalCents": lineCents}
+                      for (purchasableId, ticketClassId, description, unitPriceCents, quantity, lineCents) in lines],
+        "numTickets": sum(quantity for (_, _, _, _, quantity, _) in lines),
+        "subtotalCents": subtotalCents,
+        "taxCents": taxCents,
+        "totalCents": subtotalCents + taxCents
+    }
+
+
+
+# columns that never leave the server; live counters are served by /availability/
+hiddenFields = {"password", "soldCount", "heldCount"}
+ticketClassFields = ("id", "description", "price", "priceCents")
+serializerPlans = {}
+
+
+def serializerPlan(model, fields):
+    # compile once per model and field allowlist: (key, attribute, convert)
+    plan = serializerPlans.get((model, fields))
+    if plan is None:
+        plan = []
+        for column in db.inspect(model).column_attrs:
+            if column.key in hiddenFields:
+                continue
+            convert = None
+            if isinstance(column.columns[0].type, db.Enum):
+                convert = enumName
+            if fields is None or column.key in fields:
+                plan.append((column.key, column.key, convert))
+            if column.key == "priceCents" and (fields is None or "price" in fields):
+                plan.append(("price", "priceCents", toDollars))  # clients work in dollars
+        plan = serializerPlans[(model, fields)] = tuple(plan)
+    return plan
+
+
+def enumName(value):
+    return value.name
+
+
+def serialize(obj, fields=None):
+    result = {}
+    for (key, attribute, convert) in serializerPlan(type(obj), fields):
+        value = getattr(obj, attribute)
+        result[key] = value if convert is None or value is None else convert(value)
     return result
 
 
+def jsonDefault(value):
+    if isinstance(value, date):  # same RFC 1123 dates Flask's encoder wrote
+        return http_date(value.timetuple())
+    raise TypeError
+
+
+def jsonResponse(data, status=200):
+    return current_app.response_class(orjson.dumps(data, default=jsonDefault, option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME),
+                              status=status, mimetype="application/json")
+
+
+def serializeTicketClasses(purchasable):
+    return [serialize(rel.ticketClass, ticketClassFields) for rel in purchasable.ticketClasses]
+
+
+def requestFields(model):
+    # ?fields=id,name projects the serialized columns; id always comes along for the cursor
+    if "fields" not in request.args:
+        return None
+    fields = tuple(sorted(set(request.args["fields"].split(",")) | {"id"}))
+    if not set(fields) <= {key for (key, _, _) in serializerPlan(model, None)}:
+        abort(400)
+    return fields
+
+
+def loadFields(model, fields):
+    # only SELECT the columns the projection serializes
+    if fields is None:
+        return []
+    return [db.load_only(*{attribute for (_, attribute, _) in serializerPlan(model, fields)})]
+
+
+def pageQuery(query, column, sortColumn=None, descending=False):
+    # keyset pagination on id, e.g. ?limit=100&cursor=<last id of the previous page>;
+    # with a (non-null) sortColumn, pages are cut on (sortColumn, id) instead
+    try:
+        limit = int(request.args["limit"]) if "limit" in request.args else None
+        cursor = int(request.args["cursor"]) if "cursor" in request.args else None
+    except ValueError:
+        abort(400)
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400)
+    if sortColumn is None:
+        query = query.order_by(column)
+        if cursor is not None:
+            query = query.filter(column > cursor)
+    else:
+        query = query.order_by(sortColumn.desc(), column.desc()) if descending else query.order_by(sortColumn, column)
+        if cursor is not None:
+            cursorValue = db.session.query(sortColumn).filter(column == cursor).scalar()
+            if cursorValue is None:
+                abort(400)
+            beyond = operator.lt if descending else operator.gt
+            query = query.filter(db.or_(beyond(sortColumn, cursorValue),
+                                        db.and_(sortColumn == cursorValue, beyond(column, cursor))))
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all(), limit
+
+
+def pageResponse(data, rows, limit):
+    # a full page links to the next one; the body stays a plain list
+    response = jsonResponse(data)
+    if limit is not None and len(rows) == limit:
+        args = request.args.copy()
+        args["cursor"] = rows[-1].id
+        response.headers["Link"] = '<{}?{}>; rel="next"'.format(request.base_url, url_encode(args))
+    return response
+
+
+def userTicketsQuery(userId, isPurchased):
+    return db.session.query(Ticket).options(*cartProfile).filter(
+        Ticket.user_id == userId, Ticket.isPurchased == isPurchased)
+
+
+def getUserTickets(userId, isPurchased):
+    return userTicketsQuery(userId, isPurchased).order_by(Ticket.id).all()
+
+
+def serializeTicketsByPurchasable(tickets, fields=None):
+    purchasables = db.session.query(Purchasable).options(*catalogProfile).filter(
+        Purchasable.id.in_({ticket.purchasable_id for ticket in tickets})).order_by(Purchasable.id).all()
+    return [{**serialize(purchasable),
+             "events": [serialize(event) for event in purchasable.events],
+             "tickets": [{**serialize(ticket, fields), "ticketClass": serialize(ticket.ticketClass), "events": [serialize(event.event) for event in ticket.events]} for ticket in tickets if ticket.purchasable_id == purchasable.id]} for purchasable in purchasables]
+
+
+# bcrypt releases the GIL, so a small pool keeps every core busy while the
+# bounded queue sheds a login spike instead of stacking it on worker threads
+passwordPool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS, thread_name_prefix="password")
+passwordSlots = threading.BoundedSemaphore(PASSWORD_WORKERS + PASSWORD_QUEUE_DEPTH)
+
+
+class PasswordBusy(Exception):
+    pass
+
+
+@api.app_errorhandler(PasswordBusy)
+def passwordBusy(error):
+    return "Too many logins, retry shortly", 503, {"Retry-After": str(PASSWORD_RETRY_AFTER)}
+
+
+def greenThreadpool():
+    # under the gevent worker our "threads" are greenlets and bcrypt would
+    # stall the event loop, so hashing moves to the hub's native thread pool
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is None or not monkey.is_module_patched('threading'):
+        return None
+    threadpool = sys.modules['gevent'].get_hub().threadpool
+    threadpool.maxsize = max(threadpool.maxsize, PASSWORD_WORKERS)
+    return threadpool
+
+
+def runPasswordWork(fn, *args):
+    if not passwordSlots.acquire(blocking=False):
+        raise PasswordBusy()
+    try:
+        threadpool = greenThreadpool()
+        if threadpool is not None:
+            return threadpool.apply(fn, args)
+        return passwordPool.submit(fn, *args).result()
+    finally:
+        passwordSlots.release()
+
+
+def hashPassword(plain_text_password):
+    return bcrypt.hashpw(plain_text_password, bcrypt.gensalt(PASSWORD_HASH_ROUNDS))
+
+
 def getHashedPassword(plain_text_password):
     # Hash a password for the first time
     #   (Using bcrypt, the salt is saved into the hash itself)
-    return bcrypt.hashpw(plain_text_password, bcrypt.gensalt())
+    return runPasswordWork(hashPassword, plain_text_password)
 
 
 def checkPassword(plain_text_password, hashed_password):
     # Check hashed password. Using bcrypt, the salt is saved into the hash itself
-    return bcrypt.checkpw(plain_text_password, hashed_password)
+    return runPasswordWork(bcrypt.checkpw, plain_text_password, hashed_password)
+
+
+def needsRehash(hashed_password):
+    # py-bcrypt hashes look like "$2a$<rounds>$<salt and hash>"
+    return int(hashed_password.split('$')[2]) != PASSWORD_HASH_ROUNDS
+
+
+# Catalog cache
+#   Every gunicorn worker keeps its own LRU of rendered catalog responses. They
+#   share one generation counter: the size of CATALOG_GENERATION_FILE, which a
+#   committed catalog write grows by one byte (appends are atomic across
+#   processes). A cached response or ETag is only valid for the generation it
+#   was rendered under.
+catalogCache = OrderedDict()
+catalogCacheLock = threading.Lock()
+
+
+def getCatalogGeneration():
+    try:
+        stat = os.stat(CATALOG_GENERATION_FILE)
+    except FileNotFoundError:
+        bumpCatalogGeneration()
+        stat = os.stat(CATALOG_GENERATION_FILE)
+    return "{:x}-{:x}".format(stat.st_ino, stat.st_size)
+
+
+def bumpCatalogGeneration():
+    with open(CATALOG_GENERATION_FILE, 'ab') as generationFile:
+        generationFile.write(b'.')
+
+
+def catalogChangedRecently():
+    # the replica may not have caught up with a catalog write this young
+    return time.time() - os.stat(CATALOG_GENERATION_FILE).st_mtime < REPLICA_STICKY_SECONDS
+
+
+def markCatalogChanged():
+    # takes effect when the current transaction commits
+    db.session.info['catalogChanged'] = True
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def bumpCatalogGenerationOnCommit(session):
+    if session.info.pop('catalogChanged', False):
+        bumpCatalogGeneration()
+
+
+@db.event.listens_for(db.session, 'after_rollback')
+def discardCatalogChangeOnRollback(session):
+    session.info.pop('catalogChanged', None)
+
+
+def cachedCatalog(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # read the generation before the database so a concurrent write can
+        # only make the cached copy newer than its tag, never older
+        etag = getCatalogGeneration()
+        # for REPLICA_STICKY_SECONDS after any catalog write, every client reads
+        # from the primary; that window is the only read-your-writes guarantee
+        g.useReplica = hasReplica() and not catalogChangedRecently()
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            with catalogCacheLock:
+                entry = catalogCache.get(request.full_path)
+                if entry:
+                    catalogCache.move_to_end(request.full_path)
+            if entry and entry[0] == etag:
+                response = current_app.response_class(entry[1], mimetype="application/json")
+                if entry[2]:
+                    response.headers["Link"] = entry[2]
+            else:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code == 200:
+                    with catalogCacheLock:
+                        catalogCache[request.full_path] = (etag, response.get_data(), response.headers.get("Link"))
+                        catalogCache.move_to_end(request.full_path)
+                        while len(catalogCache) > CATALOG_CACHE_SIZE:
+                            catalogCache.popitem(last=False)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return wrapper
+
+
+# Per-request SQL and latency instrumentation, exported on /metrics. The
+# numbers are per process, which covers everything under a single gunicorn worker
+latencyBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+requestMetrics = {}
+requestMetricsLock = threading.Lock()
+
+
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def startStatementTimer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statementStarts', []).append(time.perf_counter())
+
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def recordStatement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['statementStarts'].pop()
+    if not has_request_context() or 'sqlCount' not in g:
+        return
+    g.sqlCount += 1
+    g.sqlSeconds += elapsed
+    if elapsed > g.sqlSlowest[0]:
+        g.sqlSlowest = (elapsed, statement)
+    if SQL_DEBUG:
+        g.sqlStatements[statement] += 1
+
+
+@db.event.listens_for(Engine, 'handle_error')
+def discardStatementTimer(context):
+    if context.connection is not None and context.connection.info.get('statementStarts'):
+        context.connection.info['statementStarts'].pop()
+
+
+@api.before_app_request
+def startRequestTimer():
+    g.requestStart = time.perf_counter()
+    g.sqlCount, g.sqlSeconds, g.sqlSlowest = 0, 0.0, (0.0, None)
+    g.sqlStatements = defaultdict(int)
+
+
+@api.after_app_request
+def recordRequest(response):
+    if 'requestStart' not in g:
+        return response
+    elapsed = time.perf_counter() - g.requestStart
+    endpoint = (request.endpoint or "unmatched").rpartition('.')[2]
+    with requestMetricsLock:
+        metrics = requestMetrics.setdefault(endpoint, {
+            "buckets": [0] * len(latencyBuckets), "count": 0, "seconds": 0.0, "queries": 0, "dbSeconds": 0.0, "statuses": defaultdict(int)})
+        for i, bound in enumerate(latencyBuckets):
+            if elapsed <= bound:
+                metrics["buckets"][i] += 1
+                break
+        metrics["count"] += 1
+        metrics["seconds"] += elapsed
+        metrics["queries"] += g.sqlCount
+        metrics["dbSeconds"] += g.sqlSeconds
+        metrics["statuses"][response.status_code] += 1
+
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        current_app.logger.warning("slow request %s %s: %.0fms, %d queries, %.0fms in db, slowest %.0fms: %s",
+                           request.method, request.path, elapsed * 1000, g.sqlCount, g.sqlSeconds * 1000,
+                           g.sqlSlowest[0] * 1000, g.sqlSlowest[1])
+    for statement, count in g.sqlStatements.items():
+        if count >= SQL_REPEAT_THRESHOLD:
+            current_app.logger.warning("possible N+1 in %s %s: %d x %s", request.method, request.path, count, statement)
+    return response
+
+
+# Prometheus text exposition; set METRICS_TOKEN to require "Authorization: Bearer <token>"
+@api.route("/metrics", methods=['GET'])
+def getMetrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != "Bearer " + METRICS_TOKEN:
+        return "Forbidden", 403
+    with requestMetricsLock:
+        snapshot = {endpoint: {**metrics, "buckets": list(metrics["buckets"]), "statuses": dict(metrics["statuses"])}
+                    for endpoint, metrics in requestMetrics.items()}
+
+    lines = ["# HELP folda_request_duration_seconds Request latency by endpoint",
+             "# TYPE folda_request_duration_seconds histogram"]
+    for endpoint, metrics in sorted(snapshot.items()):
+        cumulative = 0
+        for bound, count in zip(latencyBuckets, metrics["buckets"]):
+            cumulative += count
+            lines.append('folda_request_duration_seconds_bucket{{endpoint="{}",le="{}"}} {}'.format(endpoint, bound, cumulative))
+        lines.append('folda_request_duration_seconds_bucket{{endpoint="{}",le="+Inf"}} {}'.format(endpoint, metrics["count"]))
+        lines.append('folda_request_duration_seconds_sum{{endpoint="{}"}} {}'.format(endpoint, metrics["seconds"]))
+        lines.append('folda_request_duration_seconds_count{{endpoint="{}"}} {}'.format(endpoint, metrics["count"]))
+    lines += ["# HELP folda_requests_total Responses by endpoint and status",
+              "# TYPE folda_requests_total counter"]
+    for endpoint, metrics in sorted(snapshot.items()):
+        for status, count in sorted(metrics["statuses"].items()):
+            lines.append('folda_requests_total{{endpoint="{}",status="{}"}} {}'.format(endpoint, status, count))
+    lines += ["# HELP folda_db_queries_total SQL statements executed by endpoint",
+              "# TYPE folda_db_queries_total counter"]
+    lines += ['folda_db_queries_total{{endpoint="{}"}} {}'.format(endpoint, metrics["queries"])
+              for endpoint, metrics in sorted(snapshot.items())]
+    lines += ["# HELP folda_db_seconds_total Time spent in SQL statements by endpoint",
+              "# TYPE folda_db_seconds_total counter"]
+    lines += ['folda_db_seconds_total{{endpoint="{}"}} {}'.format(endpoint, metrics["dbSeconds"])
+              for endpoint, metrics in sorted(snapshot.items())]
+    return current_app.response_class("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
 
 
 # Create new user
-@app.route("/users/", methods=['POST'])
+@api.route("/users/", methods=['POST'])
 def createUser():
     name = request.json.get("name")
     emailAddress = request.json.get("emailAddress")
@@ -251,18 +893,19 @@ def createUser():
 
 
 # Get users
-@app.route("/users/", methods=['GET'])
+@api.route("/users/", methods=['GET'])
 @jwt_required
 def getUsers():
     identity = get_jwt_identity()
     if identity['isAdmin']:
-        users = db.session.query(User).all()
-        return jsonify([serialize(user) for user in users])
+        fields = requestFields(User)
+        users, limit = pageQuery(db.session.query(User).options(*loadFields(User, fields)), User.id)
+        return pageResponse([serialize(user, fields) for user in users], users, limit)
     return "Forbidden", 403
 
 
 # Get one user
-@app.route("/users/<id>/", methods=['GET'])
+@api.route("/users/<id>/", methods=['GET'])
 @jwt_required
 def getUser(id):
     identity = get_jwt_identity()
@@ -274,7 +917,7 @@ def getUser(id):
 
 
 # Update one user
-@app.route("/users/<id>/", methods=['PUT'])
+@api.route("/users/<id>/", methods=['PUT'])
 @jwt_required
 def updateUser(id):
     identity = get_jwt_identity()
@@ -286,7 +929,7 @@ def updateUser(id):
         return serialize(user)
     return "Forbidden", 403
 
-@app.route("/users/<id>/", methods=['PATCH'])
+@api.route("/users/<id>/", methods=['PATCH'])
 @jwt_required
 def updateUserpassword(id):
     identity = get_jwt_identity()
@@ -299,12 +942,13 @@ def updateUserpassword(id):
     return "Forbidden", 403
 
 # Delete one user
-@app.route("/users/<id>/", methods=['DELETE'])
+@api.route("/users/<id>/", methods=['DELETE'])
 @jwt_required
 def deleteUser(id):
     identity = get_jwt_identity()
     id = int(id)
     if identity['id'] == id or identity['isAdmin']:
+        db.session.query(QueueToken).filter(QueueToken.user_id == id).delete()
         user = db.session.query(User).filter(User.id == id).delete()
         db.session.commit()
         return "Deleted user {}".format(id)
@@ -312,18 +956,19 @@ def deleteUser(id):
 
 
 # Get admins
-@app.route("/admins/", methods=['GET'])
+@api.route("/admins/", methods=['GET'])
 @jwt_required
 def getAdmins():
     identity = get_jwt_identity()
     if identity['isAdmin']:
-        admins = db.session.query(User).filter(User.isAdmin == True).all()
-        return jsonify([serialize(admin) for admin in admins])
+        fields = requestFields(User)
+        admins, limit = pageQuery(db.session.query(User).options(*loadFields(User, fields)).filter(User.isAdmin == True), User.id)
+        return pageResponse([serialize(admin, fields) for admin in admins], admins, limit)
     return "Forbidden", 403
 
 
 # Create new admin
-@app.route("/admins/", methods=['POST'])
+@api.route("/admins/", methods=['POST'])
 @jwt_required
 def createAdmin():
     identity = get_jwt_identity()
@@ -339,7 +984,7 @@ def createAdmin():
     return "Forbidden", 403
 
 # Remove admin
-@app.route("/admins/<id>/", methods=['DELETE'])
+@api.route("/admins/<id>/", methods=['DELETE'])
 @jwt_required
 def removeAdmin(id):
     identity = get_jwt_identity()
@@ -355,19 +1000,20 @@ def removeAdmin(id):
     return "Forbidden", 403
 
 # Create new event
-@app.route("/events/", methods=['POST'])
+@api.route("/events/", methods=['POST'])
 @jwt_required
 def createEvent():
     identity = get_jwt_identity()
     if identity['isAdmin']:
+        startTime, endTime = requestEventTimes()
         event = Event(
             artistName=request.json.get("artistName"),
             description=request.json.get("description"),
             name=request.json.get("name"),
             imageUrl=request.json.get("imageUrl"),
             embedMedia=request.json.get("embedMedia"),
-            startTime=request.json.get("startTime"),
-            endTime=request.json.get("endTime"),
+            startTime=startTime,
+            endTime=endTime,
             venue=request.json.get("venue"),
             capacity=request.json.get("capacity")
         )
@@ -401,66 +1047,172 @@ def createEvent():
             event.purchasable_id = purchasable.id
 
         db.session.add(event)
+        markCatalogChanged()
         db.session.commit()
 
         event = db.session.query(Event).filter(Event.id == event.id).one()
-        purchasable = db.session.query(Purchasable).filter(
+        purchasable = db.session.query(Purchasable).options(purchasableTicketClasses).filter(
             Purchasable.id == purchasable.id).one()
 
-        tcs = db.session.query(Purchasable_TicketClass).filter(
-            Purchasable_TicketClass.purchasable_id == purchasable.id).join(TicketClass, Purchasable_TicketClass.ticketClass_id == TicketClass.id).all()
-
-        return {**serialize(event), "purchasable": {**serialize(purchasable), "ticketClasses": [{"id": tc.ticketClass.id, "description": tc.ticketClass.description, "price": tc.ticketClass.price} for tc in tcs]}}
+        return jsonResponse({**serialize(event), "purchasable": {**serialize(purchasable), "ticketClasses": serializeTicketClasses(purchasable)}})
     return "Forbidden", 403
 
 
+def eventsOverlapping(start, end):
+    # conditions for events overlapping [start, end); either bound may be None
+    if start is None and end is None:
+        return []
+    if db.engine.dialect.name == 'postgresql':  # matches the ix_Event_schedule expression
+        return [db.func.tsrange(Event.startTime, Event.endTime).op('&&')(db.func.tsrange(start, end))]
+    return ([Event.endTime > start] if start is not None else []) + ([Event.startTime < end] if end is not None else [])
+
+
+def requestWindow():
+    # ?from=&to= as ISO dates or datetimes; aborts on anything else
+    try:
+        start = datetime.fromisoformat(request.args["from"]) if "from" in request.args else None
+        end = datetime.fromisoformat(request.args["to"]) if "to" in request.args else None
+    except ValueError:
+        abort(400)
+    if start is not None and end is not None and start > end:
+        abort(400)
+    return start, end
+
+
+def parseEventTime(value):
+    # the http-dates this API returns (clients send them back unchanged on
+    # PUT) or ISO datetimes; offsets are folded into the columns' naive UTC
+    parsed = parse_date(value)
+    if parsed is None:
+        parsed = datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def requestEventTimes():
+    # startTime and endTime from the body; aborts unless the event ends no
+    # earlier than it starts, which tsrange in ix_Event_schedule requires
+    try:
+        startTime, endTime = (parseEventTime(value) for value in (request.json["startTime"], request.json["endTime"]))
+    except (KeyError, TypeError, AttributeError, ValueError):
+        abort(400)
+    if endTime < startTime:
+        abort(400)
+    return startTime, endTime
+
+
+# Get one slice of the schedule, e.g. /events/?from=2020-07-04&to=2020-07-05&venue=Main%20Stage&sort=startTime
+@api.route("/events/", methods=['GET'])
+@cachedCatalog
+def getEvents():
+    start, end = requestWindow()
+    sort = request.args.get("sort", "startTime")
+    if sort.lstrip("-") not in ("startTime", "endTime"):
+        return "Bad request", 400
+    fields = requestFields(Event)
+    query = db.session.query(Event).options(*loadFields(Event, fields)).filter(*eventsOverlapping(start, end))
+    if "venue" in request.args:
+        query = query.filter(Event.venue == request.args["venue"])
+    events, limit = pageQuery(query, Event.id, getattr(Event, sort.lstrip("-")), sort.startswith("-"))
+    return pageResponse([serialize(event, fields) for event in events], events, limit)
+
+
+# Find the events a new or moved event would clash with, e.g.
+# /events/overlaps/?venue=Main%20Stage&from=2020-07-04T20:00&to=2020-07-04T22:00&exclude=12
+@api.route("/events/overlaps/", methods=['GET'])
+@jwt_required
+def getEventOverlaps():
+    identity = get_jwt_identity()
+    if not identity['isAdmin']:
+        return "Forbidden", 403
+    start, end = requestWindow()
+    if not request.args.get("venue") or start is None or end is None:
+        return "Bad request", 400
+    query = db.session.query(Event).filter(Event.venue == request.args["venue"], *eventsOverlapping(start, end))
+    if "exclude" in request.args:
+        try:
+            query = query.filter(Event.id != int(request.args["exclude"]))
+        except ValueError:
+            return "Bad request", 400
+    return jsonResponse([serialize(event) for event in query.order_by(Event.startTime, Event.id)])
+
+
 # Get events
-@app.route("/individualEvents/", methods=['GET'])
+@api.route("/individualEvents/", methods=['GET'])
+@cachedCatalog
 def getIndividualEvents():
     events = db.session.query(Event, Purchasable).filter(
         Event.purchasable_id == Purchasable.id).filter(Purchasable.type == PurchasableTypes2.individual).all()
 
-    return jsonify([{**serialize(event), "purchasable": serialize(purchasable)} for (event, purchasable) in events])
+    return jsonResponse([{**serialize(event), "purchasable": serialize(purchasable)} for (event, purchasable) in events])
 
 
 # Get one event
-@app.route("/events/<id>/", methods=['GET'])
+@api.route("/events/<id>/", methods=['GET'])
+@cachedCatalog
 def getEvent(id):
     event = db.session.query(Event).filter(Event.id == id).one()
 
     # add related purchasable to event
-    purchasable = db.session.query(Purchasable).filter(
+    purchasable = db.session.query(Purchasable).options(purchasableTicketClasses).filter(
         Purchasable.id == event.purchasable_id).one()
 
-    tcs = db.session.query(Purchasable_TicketClass).filter(Purchasable_TicketClass.purchasable_id == purchasable.id).join(
-        TicketClass, Purchasable_TicketClass.ticketClass_id == TicketClass.id).all()
-
-    return {**serialize(event), "purchasable": {**serialize(purchasable), "ticketClasses": [{"id": tc.ticketClass.id, "description": tc.ticketClass.description, "price": tc.ticketClass.price} for tc in tcs]}}
+    return jsonResponse({**serialize(event), "purchasable": {**serialize(purchasable), "ticketClasses": serializeTicketClasses(purchasable)}})
 
 
 # Update one event
-@app.route("/events/<id>/", methods=['PUT'])
+@api.route("/events/<id>/", methods=['PUT'])
 @jwt_required
 def updateEvent(id):
     identity = get_jwt_identity()
     id = int(id)
     if identity['isAdmin']:
+        startTime, endTime = requestEventTimes()
         event = db.session.query(Event).filter(Event.id == id).one()
-        event.artistName = request.json.get("artistName"),
-        event.description = request.json.get("description"),
-        event.name = request.json.get("name"),
-        event.imageUrl=request.json.get("imageUrl"),
-        event.embedMedia=request.json.get("embedMedia"),
-        event.startTime = request.json.get("startTime"),
-        event.endTime = request.json.get("endTime"),
-        event.venue = request.json.get("venue"),
+        event.artistName = request.json.get("artistName")
+        event.description = request.json.get("description")
+        event.name = request.json.get("name")
+        event.imageUrl = request.json.get("imageUrl")
+        event.embedMedia = request.json.get("embedMedia")
+        event.startTime = startTime
+        event.endTime = endTime
+        event.venue = request.json.get("venue")
         event.capacity = request.json.get("capacity")
+        db.session.flush()
+        refreshInventoryFlags([event.purchasable_id])
+        markCatalogChanged()
         db.session.commit()
         return serialize(event)
     return "Forbidden", 403
 
+
+# Email everyone holding a purchased ticket for an event
+@api.route("/events/<id>/notify/", methods=['POST'])
+@jwt_required
+def notifyEventTicketHolders(id):
+    identity = get_jwt_identity()
+    id = int(id)
+    if identity['isAdmin']:
+        subject = request.json.get("subject")
+        body = request.json.get("body")
+        if not subject or not body:
+            return "Bad request", 400
+
+        recipients = db.session.query(User.emailAddress).join(Ticket, Ticket.user_id == User.id).join(
+            Event_Ticket, Event_Ticket.ticket_id == Ticket.id).filter(Event_Ticket.event_id == id, Ticket.isPurchased == True).distinct().all()
+        if recipients:
+            # queued for `flask outbox-worker`, which sends them in batches over one connection
+            db.session.execute(Outbox.__table__.insert(), [{
+                "kind": "eventNotice",
+                "payload": json.dumps({"subject": subject, "recipients": [emailAddress], "body": body})
+            } for (emailAddress,) in recipients])
+        db.session.commit()
+        return jsonResponse({"queued": len(recipients)})
+    return "Forbidden", 403
+
 # Create new purchasable
-@app.route("/purchasables/", methods=['POST'])
+@api.route("/purchasables/", methods=['POST'])
 @jwt_required
 def createDayPass():
     identity = get_jwt_identity()
@@ -480,6 +1232,7 @@ def createDayPass():
                 purchasable_id=purchasable.id, ticketClass_id=tc_id)
             db.session.add(relationship)
 
+        markCatalogChanged()
         db.session.commit()
         purchasable = db.session.query(Purchasable).filter(
             Purchasable.id == purchasable.id).one()
@@ -488,40 +1241,41 @@ def createDayPass():
 
 
 # Get purchasables
-@app.route("/purchasables/", methods=['GET'])
+@api.route("/purchasables/", methods=['GET'])
+@cachedCatalog
 def getPurchasables():
-    purchasables = db.session.query(Purchasable).all()
+    fields = requestFields(Purchasable)
+    purchasables, limit = pageQuery(db.session.query(Purchasable).options(*catalogProfile, *loadFields(Purchasable, fields)), Purchasable.id)
 
-    return jsonify([
+    return pageResponse([
         {
-            **serialize(p),
+            **serialize(p, fields),
             "events": [serialize(e) for e in p.events],
             "startTime":  min([e.startTime for e in p.events]) if len(p.events) else None
-        } for p in purchasables])
+        } for p in purchasables], purchasables, limit)
 
 
 # Get day passes
-@app.route("/dayPasses/", methods=['GET'])
+@api.route("/dayPasses/", methods=['GET'])
+@cachedCatalog
 def getDayPasses():
-    purchasables = db.session.query(Purchasable).filter(
+    purchasables = db.session.query(Purchasable).options(*catalogProfile).filter(
         Purchasable.type == PurchasableTypes2.dayPass).all()
-    return jsonify([{**serialize(p), "events": [serialize(e) for e in p.events]} for p in purchasables])
+    return jsonResponse([{**serialize(p), "events": [serialize(e) for e in p.events]} for p in purchasables])
 
 
 # Get one purchasable
-@app.route("/purchasables/<id>/", methods=['GET'])
+@api.route("/purchasables/<id>/", methods=['GET'])
+@cachedCatalog
 def getPurchasable(id):
-    purchasable = db.session.query(Purchasable).filter(
+    purchasable = db.session.query(Purchasable).options(*adminProfile).filter(
         Purchasable.id == id).one()
 
-    tcs = db.session.query(Purchasable_TicketClass).filter(Purchasable_TicketClass.purchasable_id == purchasable.id).join(
-        TicketClass, Purchasable_TicketClass.ticketClass_id == TicketClass.id).all()
-
-    return {**serialize(purchasable), "events": [serialize(e) for e in purchasable.events], "ticketClasses": [{"id": tc.ticketClass.id, "description": tc.ticketClass.description, "price": tc.ticketClass.price} for tc in tcs]}
+    return jsonResponse({**serialize(purchasable), "events": [serialize(e) for e in purchasable.events], "ticketClasses": serializeTicketClasses(purchasable)})
 
 
 # Update one purchasable
-@app.route("/purchasables/<id>/", methods=['PUT'])
+@api.route("/purchasables/<id>/", methods=['PUT'])
 @jwt_required
 def updatePurchasable(id):
     identity = get_jwt_identity()
@@ -544,18 +1298,21 @@ def updatePurchasable(id):
                     purchasable_id=purchasable.id, ticketClass_id=tc_id)
                 db.session.add(relationship)
 
-        for tc_id in currentTicketClasses:  # remove old ticketClasses
-            if tc_id not in ticketClasses:
-                db.session.query(Purchasable_TicketClass).filter(Purchasable_TicketClass.purchasable_id == purchasable.id).filter(
-                    Purchasable_TicketClass.ticketClass_id == tc_id).delete()
+        removedTicketClasses = [tc_id for tc_id in currentTicketClasses if tc_id not in ticketClasses]
+        if removedTicketClasses:  # remove old ticketClasses in one DELETE
+            db.session.query(Purchasable_TicketClass).filter(Purchasable_TicketClass.purchasable_id == purchasable.id).filter(
+                Purchasable_TicketClass.ticketClass_id.in_(removedTicketClasses)).delete(synchronize_session=False)
 
+        db.session.flush()
+        refreshInventoryFlags([purchasable.id])
+        markCatalogChanged()
         db.session.commit()
         return serialize(purchasable)
     return "Forbidden", 403
 
 
 # Delete one purchasable
-@app.route("/purchasables/<id>/", methods=['DELETE'])
+@api.route("/purchasables/<id>/", methods=['DELETE'])
 @jwt_required
 def deletePurchasable(id):
     identity = get_jwt_identity()
@@ -571,8 +1328,12 @@ def deletePurchasable(id):
         db.session.query(Purchasable_TicketClass).filter(
             Purchasable_TicketClass.purchasable_id == id).delete()
 
+        # delete its sales rollups
+        db.session.query(SalesRollup).filter(SalesRollup.purchasable_id == id).delete()
+
         # delete purchasable
         db.session.query(Purchasable).filter(Purchasable.id == id).delete()
+        markCatalogChanged()
         db.session.commit()
 
         return "Deleted purchasable {}".format(id)
@@ -580,7 +1341,7 @@ def deletePurchasable(id):
 
 
 # Create new TicketClass
-@app.route("/ticketClasses/", methods=['POST'])
+@api.route("/ticketClasses/", methods=['POST'])
 @jwt_required
 def createTicketClass():
     identity = get_jwt_identity()
@@ -591,9 +1352,10 @@ def createTicketClass():
         if description and price:
             ticketClass = TicketClass(
                 description=description,
-                price=price
+                priceCents=toCents(price)
             )
             db.session.add(ticketClass)
+            markCatalogChanged()
             db.session.commit()
             ticketClass = db.session.query(TicketClass).filter(
                 TicketClass.id == ticketClass.id).one()
@@ -605,104 +1367,893 @@ def createTicketClass():
 
 
 # Get ticketClasses
-@app.route("/ticketClasses/", methods=['GET'])
+@api.route("/ticketClasses/", methods=['GET'])
+@cachedCatalog
 def getTicketClasss():
-    ticketClasses = db.session.query(TicketClass).all()
-    return jsonify([serialize(ticketClass) for ticketClass in ticketClasses])
+    fields = requestFields(TicketClass)
+    ticketClasses, limit = pageQuery(db.session.query(TicketClass).options(*loadFields(TicketClass, fields)), TicketClass.id)
+    return pageResponse([serialize(ticketClass, fields) for ticketClass in ticketClasses], ticketClasses, limit)
+
+
+# Search
+#   On Postgres, events and purchasables are matched against GIN indexes over
+#   a weighted tsvector of their text (names count more than descriptions).
+#   The indexes are on the expression itself, so every write keeps them
+#   current. Other databases, i.e. SQLite test runs, get an in-process
+#   inverted index instead, rebuilt whenever a catalog write handler moves
+#   the catalog generation. Every query term matches as a prefix, for typeahead.
+searchColumns = {
+    "Event": (("name", "artistName"), ("description",)),
+    "Purchasable": (("name",), ("description",)),
+}
+searchWeights = (1.0, 0.2)  # ts_rank's defaults for weights A and C
+
+
+def searchVectorSql(table, qualified=True):
+    # the same expression the ix_<table>_search index is built on
+    prefix = '"{}".'.format(table) if qualified else ''
+    names, descriptions = [" || ' ' || ".join("coalesce({}\"{}\", '')".format(prefix, column) for column in columns)
+                           for columns in searchColumns[table]]
+    return "setweight(to_tsvector('simple', {}), 'A') || setweight(to_tsvector('simple', {}), 'C')".format(names, descriptions)
+
+
+for searchTable in (Event.__table__, Purchasable.__table__):
+    db.event.listen(searchTable, 'after_create', db.DDL('CREATE INDEX "ix_{0}_search" ON "{0}" USING gin (({1}))'.format(
+        searchTable.name, searchVectorSql(searchTable.name, qualified=False))).execute_if(dialect='postgresql'))
+
+
+def searchTokens(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def searchTerms(text):
+    # queries are cut to their first few words; documents are indexed whole
+    return searchTokens(text)[:8]
+
+
+def searchQuery(model, terms):
+    vector = db.literal_column("({})".format(searchVectorSql(model.__tablename__)))
+    query = db.func.to_tsquery('simple', " & ".join("'{}':*".format(term) for term in terms))
+    return db.session.query(model).filter(vector.op('@@')(query)).order_by(
+        db.func.ts_rank(vector, query).desc(), model.id)
+
+
+searchIndex = {}
+searchIndexLock = threading.Lock()
+
+
+def fallbackSearchIndex():
+    # {table: (sorted tokens, {token: {id: weight}})} for the current generation
+    generation = getCatalogGeneration()
+    with searchIndexLock:
+        if searchIndex.get("generation") != generation:
+            searchIndex.clear()
+            for model in (Event, Purchasable):
+                postings = defaultdict(dict)
+                for fields, weight in zip(searchColumns[model.__tablename__], searchWeights):
+                    for row in db.session.query(model.id, *[getattr(model, field) for field in fields]):
+                        for token in searchTokens(" ".join(value for value in row[1:] if value)):
+                            postings[token][row.id] = max(weight, postings[token].get(row.id, 0))
+                searchIndex[model.__tablename__] = (sorted(postings), postings)
+            searchIndex["generation"] = generation
+        return searchIndex
+
+
+def fallbackSearch(model, terms, limit):
+    tokens, postings = fallbackSearchIndex()[model.__tablename__]
+    scores = None
+    for term in terms:
+        termScores = {}
+        position = bisect.bisect_left(tokens, term)
+        while position < len(tokens) and tokens[position].startswith(term):
+            for id, weight in postings[tokens[position]].items():
+                termScores[id] = max(weight, termScores.get(id, 0))
+            position += 1
+        scores = termScores if scores is None else {id: scores[id] + score for id, score in termScores.items() if id in scores}
+    ids = sorted(scores, key=lambda id: (-scores[id], id))[:limit]
+    rows = {row.id: row for row in db.session.query(model).filter(model.id.in_(ids))} if ids else {}
+    return [rows[id] for id in ids if id in rows]
+
+
+def searchCatalog(model, terms, limit):
+    if db.engine.dialect.name == 'postgresql':
+        return searchQuery(model, terms).limit(limit).all()
+    return fallbackSearch(model, terms, limit)
+
+
+# Search events and purchasables as the user types, e.g. /search/?q=daft%20pu&limit=10
+@api.route("/search/", methods=['GET'])
+@cachedCatalog
+def search():
+    terms = searchTerms(request.args.get("q", ""))
+    try:
+        limit = int(request.args.get("limit", 20))
+    except ValueError:
+        return "Bad request", 400
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        return "Bad request", 400
+    if not terms:
+        return jsonResponse({"events": [], "purchasables": []})
+    return jsonResponse({"events": [serialize(event) for event in searchCatalog(Event, terms, limit)],
+                         "purchasables": [serialize(purchasable) for purchasable in searchCatalog(Purchasable, terms, limit)]})
+
+
+# Catalog import
+#   A festival program has one row per event (CSV or NDJSON) naming the
+#   purchasable it belongs to; a row without an event only declares its
+#   purchasable. Ticket classes are matched by description, purchasables by
+#   name and events by name within their purchasable. The first row naming a
+#   purchasable sets its fields, and its ticketClasses (if given) replace the
+#   purchasable's current links. Rows are read IMPORT_BATCH_SIZE at a time and
+#   each batch is written with a few multi-row statements per table, all in
+#   the caller's transaction.
+class CatalogImportError(Exception):
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.message = message
+
+
+purchasableImportFields = ("type", "numTickets", "description")
+eventImportFields = ("artistName", "description", "imageUrl", "embedMedia", "startTime", "endTime", "venue", "capacity")
+
+
+def programRows(lines, format):
+    # lines are raw bytes, read lazily from the upload or file
+    text = (line.decode('utf-8-sig') for line in lines)
+    if format == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, {key: value for key, value in row.items() if key is not None and value != ""}
+    else:
+        for lineNumber, line in enumerate(text, 1):
+            if not line.strip():
+                continue
+            try:
+                row = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                raise CatalogImportError("line {}: not valid JSON".format(lineNumber))
+            if not isinstance(row, dict):
+                raise CatalogImportError("line {}: expected an object".format(lineNumber))
+            yield lineNumber, {key: value for key, value in row.items() if value is not None and value != ""}
+
+
+def requiredField(row, field):
+    if field not in row:
+        raise ValueError("{} is required".format(field))
+    return row[field]
+
+
+def parseTicketClasses(value):
+    # "Adult=45.00;Youth=30" in CSV, {"Adult": 45.0, "Youth": 30} in NDJSON;
+    # a description without a price refers to an existing ticket class
+    if isinstance(value, str):
+        value = dict((part.split("=", 1) + [None])[:2] for part in value.split(";") if part.strip())
+    elif isinstance(value, list):
+        value = dict.fromkeys(value)
+    return {str(description).strip(): None if price is None or price == "" else toCents(price)
+            for description, price in value.items()}
+
+
+def parseProgramRow(row):
+    # only the fields the row gives: updates keep the current value of the
+    # rest, and defaults are filled in when a row is created
+    event = None
+    if "event" in row:
+        event = {"name": row["event"]}
+        for field in ("artistName", "description", "imageUrl", "embedMedia", "venue"):
+            if field in row:
+                event[field] = row[field]
+        for field in ("startTime", "endTime"):
+            if field in row:
+                event[field] = datetime.fromisoformat(row[field])
+        if "capacity" in row:
+            event["capacity"] = int(row["capacity"])
+
+    purchasable = {"name": requiredField(row, "purchasable")}
+    if "type" in row:
+        if row["type"] not in PurchasableTypes2.__members__:
+            raise ValueError("unknown type {}".format(row["type"]))
+        purchasable["type"] = PurchasableTypes2[row["type"]]
+    if "numTickets" in row:
+        purchasable["numTickets"] = int(row["numTickets"])
+    if "purchasableDescription" in row:
+        purchasable["description"] = row["purchasableDescription"]
+    ticketClasses = parseTicketClasses(row["ticketClasses"]) if "ticketClasses" in row else None
+    return purchasable, ticketClasses, event
+
+
+def diffFields(existing, values, fields):
+    return {field: [enumName(existing[field]) if isinstance(existing[field], enum.Enum) else existing[field],
+                    enumName(values[field]) if isinstance(values[field], enum.Enum) else values[field]]
+            for field in fields if field in values and existing[field] != values[field]}
+
+
+def updateRowsById(table, rows):
+    # one executemany UPDATE per set of columns the rows carry
+    byColumns = defaultdict(list)
+    for row in rows:
+        byColumns[tuple(sorted(row))].append(row)
+    for columnRows in byColumns.values():
+        db.session.execute(table.update().where(table.c.id == db.bindparam('_id')), columnRows)
+
+
+def importTicketClasses(prices, state, diff):
+    wanted = {}
+    for lineNumber, description, priceCents in prices:
+        # both tuples end in the price seen so far
+        knownPriceCents = state["ticketClasses"].get(description, wanted.get(description, (None, None)))[1]
+        if priceCents is not None and knownPriceCents is not None and priceCents != knownPriceCents:
+            raise CatalogImportError("line {}: ticket class {} has two prices".format(lineNumber, description))
+        if description not in state["ticketClasses"] and knownPriceCents is None:
+            wanted[description] = (lineNumber, priceCents)
+    if not wanted:
+        return
+
+    existing = {}
+    for (id, description, priceCents) in db.session.query(TicketClass.id, TicketClass.description, TicketClass.priceCents).filter(
+            TicketClass.description.in_(list(wanted))).order_by(TicketClass.id.desc()):
+        existing[description] = (id, priceCents)  # the oldest of any duplicates wins
+
+    created, updated = [], []
+    for description, (lineNumber, priceCents) in wanted.items():
+        if description in existing:
+            id, oldPriceCents = existing[description]
+            if priceCents is not None and priceCents != oldPriceCents:
+                updated.append({"_id": id, "priceCents": priceCents})
+                diff["ticketClasses"]["updated"].append({"name": description, "changes": {"priceCents": [oldPriceCents, priceCents]}})
+            else:
+                diff["ticketClasses"]["unchanged"] += 1
+            state["ticketClasses"][description] = (id, priceCents if priceCents is not None else oldPriceCents)
+        elif priceCents is None:
+            raise CatalogImportError("line {}: ticket class {} does not exist and has no price".format(lineNumber, description))
+        else:
+            created.append({"description": description, "priceCents": priceCents})
+            diff["ticketClasses"]["created"].append({"name": description})
+
+    updateRowsById(TicketClass.__table__, updated)
+    if created:
+        for values, id in zip(created, insertReturningIds(TicketClass.__table__, created)):
+            state["ticketClasses"][values["description"]] = (id, values["priceCents"])
+
+
+def importPurchasables(purchasables, state, diff):
+    existing = {}
+    for row in db.session.query(Purchasable.id, Purchasable.name, *[getattr(Purchasable, field) for field in purchasableImportFields]).filter(
+            Purchasable.name.in_(list(purchasables))).order_by(Purchasable.id.desc()):
+        existing[row.name] = row._asdict()  # the oldest of any duplicates wins
+
+    created, updated = [], []
+    for name, (lineNumber, values, _, event) in purchasables.items():
+        if name in existing:
+            changes = diffFields(existing[name], values, purchasableImportFields)
+            if changes:
+                updated.append({"_id": existing[name]["id"], **{field: values[field] for field in changes}})
+                diff["purchasables"]["updated"].append({"name": name, "changes": changes})
+            else:
+                diff["purchasables"]["unchanged"] += 1
+            state["purchasables"][name] = existing[name]["id"]
+        else:
+            # like createEvent: an individual, described and sized like its event
+            values = {"type": PurchasableTypes2.individual,
+                      "description": event.get("description", name) if event else name, **values}
+            if "numTickets" not in values:
+                if not event or "capacity" not in event:
+                    raise CatalogImportError("line {}: numTickets is required".format(lineNumber))
+                values["numTickets"] = event["capacity"]
+            created.append(values)
+            diff["purchasables"]["created"].append({"name": name})
+
+    updateRowsById(Purchasable.__table__, updated)
+    if created:
+        for values, id in zip(created, insertReturningIds(Purchasable.__table__, created)):
+            state["purchasables"][values["name"]] = id
+
+
+def importLinks(purchasables, state, diff):
+    # the program's ticket classes replace each purchasable's links
+    wanted = {(state["purchasables"][name], state["ticketClasses"][description][0])
+              for name, (_, _, ticketClasses, _) in purchasables.items() if ticketClasses is not None
+              for description in ticketClasses}
+    purchasableIds = [state["purchasables"][name] for name, (_, _, ticketClasses, _) in purchasables.items() if ticketClasses is not None]
+    if not purchasableIds:
+        return
+
+    current, removed = set(), []
+    for (id, purchasableId, ticketClassId) in db.session.query(
+            Purchasable_TicketClass.id, Purchasable_TicketClass.purchasable_id, Purchasable_TicketClass.ticketClass_id).filter(
+            Purchasable_TicketClass.purchasable_id.in_(purchasableIds)):
+        if (purchasableId, ticketClassId) in wanted and (purchasableId, ticketClassId) not in current:
+            current.add((purchasableId, ticketClassId))
+        else:
+            removed.append(id)
+    added = [{"purchasable_id": purchasableId, "ticketClass_id": ticketClassId}
+             for (purchasableId, ticketClassId) in sorted(wanted - current)]
+
+    if removed:
+        db.session.query(Purchasable_TicketClass).filter(
+            Purchasable_TicketClass.id.in_(removed)).delete(synchronize_session=False)
+    if added:
+        db.session.execute(Purchasable_TicketClass.__table__.insert().values(added))
+    diff["links"]["added"] += len(added)
+    diff["links"]["removed"] += len(removed)
+
+
+def importEvents(events, state, diff):
+    keys = {}
+    for lineNumber, purchasableName, values in events:
+        key = (state["purchasables"][purchasableName], values["name"])
+        if key in state["events"] or key in keys:
+            raise CatalogImportError("line {}: event {} appears twice in {}".format(lineNumber, values["name"], purchasableName))
+        keys[key] = (lineNumber, purchasableName, values)
+    state["events"].update(keys)
+
+    existing = {}
+    for row in db.session.query(Event.id, Event.purchasable_id, Event.name, *[getattr(Event, field) for field in eventImportFields]).filter(
+            Event.purchasable_id.in_(list({purchasableId for (purchasableId, _) in keys})),
+            Event.name.in_(list({name for (_, name) in keys}))).order_by(Event.id.desc()):
+        existing[(row.purchasable_id, row.name)] = row._asdict()
+
+    created, updated = [], []
+    for key, (lineNumber, purchasableName, values) in keys.items():
+        if key not in existing:
+            for field in ("description", "startTime", "endTime"):
+                if field not in values:
+                    raise CatalogImportError("line {}: {} is required".format(lineNumber, field))
+        times = {**existing.get(key, {}), **values}
+        if times["endTime"] < times["startTime"]:
+            raise CatalogImportError("line {}: endTime is before startTime".format(lineNumber))
+
+        if key in existing:
+            changes = diffFields(existing[key], values, eventImportFields)
+            if changes:
+                updated.append({"_id": existing[key]["id"], **{field: values[field] for field in changes}})
+                diff["events"]["updated"].append({"name": values["name"], "purchasable": purchasableName, "changes": changes})
+            else:
+                diff["events"]["unchanged"] += 1
+        else:
+            created.append({**dict.fromkeys(eventImportFields), **values, "purchasable_id": key[0]})
+            diff["events"]["created"].append({"name": values["name"], "purchasable": purchasableName})
+
+    updateRowsById(Event.__table__, updated)
+    if created:
+        db.session.execute(Event.__table__.insert().values(created))
+
+
+def importBatch(batch, state, diff):
+    purchasables = OrderedDict()  # purchasables first named in this batch
+    events = []
+    for lineNumber, purchasable, ticketClasses, event in batch:
+        name = purchasable["name"]
+        if name not in state["purchasables"] and name not in purchasables:
+            purchasables[name] = (lineNumber, purchasable, ticketClasses, event)
+        if event is not None:
+            events.append((lineNumber, name, event))
+
+    importTicketClasses([(lineNumber, description, priceCents) for (lineNumber, _, ticketClasses, _) in purchasables.values()
+                         if ticketClasses is not None for description, priceCents in ticketClasses.items()], state, diff)
+    if purchasables:
+        importPurchasables(purchasables, state, diff)
+        importLinks(purchasables, state, diff)
+    if events:
+        importEvents(events, state, diff)
+
+
+def importCatalog(rows, batchSize=IMPORT_BATCH_SIZE):
+    # writes within the current transaction; the caller commits or rolls back
+    diff = {kind: {"created": [], "updated": [], "unchanged": 0} for kind in ("ticketClasses", "purchasables", "events")}
+    diff["links"] = {"added": 0, "removed": 0}
+    state = {"ticketClasses": {}, "purchasables": {}, "events": {}}
+    batch = []
+    for lineNumber, row in rows:
+        try:
+            batch.append((lineNumber, *parseProgramRow(row)))
+        except (ValueError, TypeError, InvalidOperation) as error:
+            raise CatalogImportError("line {}: {}".format(lineNumber, error))
+        if len(batch) == batchSize:
+            importBatch(batch, state, diff)
+            batch = []
+    if batch:
+        importBatch(batch, state, diff)
+
+    if any(diff[kind]["created"] or diff[kind]["updated"] for kind in ("ticketClasses", "purchasables", "events")) or any(diff["links"].values()):
+        # capacities may have moved past the sold and held counters
+        refreshInventoryFlags(list(state["purchasables"].values()))
+        markCatalogChanged()
+    return diff
+
+
+# Import a festival program, e.g. POST /catalog/import/?format=csv&dryRun=yes with the file as the body
+@api.route("/catalog/import/", methods=['POST'])
+@jwt_required
+def importCatalogProgram():
+    identity = get_jwt_identity()
+    if not identity['isAdmin']:
+        return "Forbidden", 403
+    format = request.args.get("format", "ndjson")
+    if format not in ("ndjson", "csv"):
+        return "Bad request", 400
+    dryRun = request.args.get("dryRun") == "yes"
+
+    try:
+        diff = importCatalog(programRows(request.stream, format))
+    except CatalogImportError as e:
+        db.session.rollback()
+        return e.message, 400
+    if dryRun:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    return jsonResponse({**diff, "dryRun": dryRun})
+
+
+# Get live ticket counts, e.g. /availability/?ids=1,2,3
+@api.route("/availability/", methods=['GET'])
+def getAvailability():
+    try:
+        ids = [int(id) for id in request.args.get("ids", "").split(",") if id]
+    except ValueError:
+        return "Bad request", 400
+    if not ids:
+        return "Bad request", 400
+
+    def remaining(limit, sold, held):
+        return None if limit is None else max(limit - sold - held, 0)
+
+    events = {}
+    for (id, purchasableId, capacity, soldCount, heldCount, isFull) in db.session.query(Event.id, Event.purchasable_id, Event.capacity, Event.soldCount, Event.heldCount, Event.isFull).filter(
+            Event.purchasable_id.in_(ids)).order_by(Event.id):
+        events.setdefault(purchasableId, []).append({"id": id, "capacity": capacity, "soldCount": soldCount, "heldCount": heldCount,
+                                                     "remaining": remaining(capacity, soldCount, heldCount), "isFull": isFull})
+
+    return jsonResponse([{"id": id, "numTickets": numTickets, "soldCount": soldCount, "heldCount": heldCount,
+                          "remaining": remaining(numTickets, soldCount, heldCount), "isSoldOut": isSoldOut, "events": events.get(id, [])}
+                         for (id, numTickets, soldCount, heldCount, isSoldOut) in db.session.query(Purchasable.id, Purchasable.numTickets, Purchasable.soldCount, Purchasable.heldCount, Purchasable.isSoldOut).filter(
+                             Purchasable.id.in_(ids)).order_by(Purchasable.id)])
+
+
+class ReservationError(Exception):
+    def __init__(self, message, status=409):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status = status
+
+
+def insertReturningIds(table, rows):
+    # one multi-row INSERT per call; Postgres hands the ids back directly,
+    # SQLite assigns consecutive rowids within a single statement
+    statement = table.insert().values(rows)
+    if db.engine.dialect.name == 'postgresql':
+        return [row[0] for row in db.session.execute(statement.returning(table.c.id))]
+    lastId = db.session.execute(statement).lastrowid
+    return list(range(lastId - len(rows) + 1, lastId + 1))
+
+
+def updateReturningIds(table, condition, values):
+    # UPDATE ... RETURNING id on Postgres; elsewhere read the ids first, which
+    # is equivalent as long as the caller holds locks on the matching rows
+    statement = table.update().where(condition).values(values)
+    if db.engine.dialect.name == 'postgresql':
+        return [row[0] for row in db.session.execute(statement.returning(table.c.id))]
+    ids = [row[0] for row in db.session.execute(db.select([table.c.id]).where(condition))]
+    db.session.execute(statement)
+    return ids
+
+
+def adjustInventoryCounters(ticketIds, held=0, sold=0):
+    # move the given tickets between the held and sold counters of their
+    # purchasables and events; call before the tickets are deleted
+    if not ticketIds:
+        return
+    purchasableCounts = db.session.query(Ticket.purchasable_id, db.func.count(Ticket.id)).filter(
+        Ticket.id.in_(ticketIds)).group_by(Ticket.purchasable_id).order_by(Ticket.purchasable_id).all()
+    eventCounts = db.session.query(Event_Ticket.event_id, db.func.count(Event_Ticket.id)).filter(
+        Event_Ticket.ticket_id.in_(ticketIds)).group_by(Event_Ticket.event_id).order_by(Event_Ticket.event_id).all()
+
+    # take the counter rows in the same order as reserveCartItems (purchasables,
+    # then events, each by id) so concurrent writers queue instead of deadlocking
+    db.session.query(Purchasable.id).filter(Purchasable.id.in_(
+        [purchasableId for (purchasableId, _) in purchasableCounts])).order_by(Purchasable.id).with_for_update().all()
+    if eventCounts:
+        db.session.query(Event.id).filter(Event.id.in_(
+            [eventId for (eventId, _) in eventCounts])).order_by(Event.id).with_for_update().all()
+
+    for purchasableId, count in purchasableCounts:
+        db.session.execute(Purchasable.__table__.update().where(Purchasable.id == purchasableId).values(
+            heldCount=Purchasable.heldCount + held * count, soldCount=Purchasable.soldCount + sold * count))
+    for eventId, count in eventCounts:
+        db.session.execute(Event.__table__.update().where(Event.id == eventId).values(
+            heldCount=Event.heldCount + held * count, soldCount=Event.soldCount + sold * count))
+
+
+def refreshInventoryFlags(purchasableIds):
+    # recompute isSoldOut / isFull from the counters in one UPDATE per table
+    if not purchasableIds:
+        return
+    isSoldOut = db.and_(Purchasable.numTickets != None,
+                        Purchasable.soldCount + Purchasable.heldCount >= Purchasable.numTickets)
+    changed = db.session.execute(Purchasable.__table__.update().where(db.and_(
+        Purchasable.id.in_(purchasableIds), Purchasable.isSoldOut != isSoldOut)).values(isSoldOut=isSoldOut)).rowcount
+
+    isFull = db.and_(Event.capacity != None, Event.soldCount + Event.heldCount >= Event.capacity)
+    changed += db.session.execute(Event.__table__.update().where(db.and_(
+        Event.purchasable_id.in_(purchasableIds), Event.isFull != isFull)).values(isFull=isFull)).rowcount
+
+    if changed:  # the catalog shows these flags
+        markCatalogChanged()
+
+
+def releaseExpiredHolds(purchasableIds=None, userId=None, batchSize=500):
+    # delete one batch of lapsed cart holds and give their capacity back
+    query = db.session.query(Ticket.id, Ticket.purchasable_id).filter(
+        Ticket.isPurchased == False, Ticket.holdExpiresAt < datetime.utcnow())
+    if purchasableIds is not None:
+        query = query.filter(Ticket.purchasable_id.in_(purchasableIds))
+    if userId is not None:
+        query = query.filter(Ticket.user_id == userId)
+    expired = query.order_by(Ticket.id).limit(batchSize).with_for_update(skip_locked=True).all()
+    if not expired:
+        return 0
+
+    ticketIds = [ticketId for (ticketId, _) in expired]
+    adjustInventoryCounters(ticketIds, held=-1)
+    db.session.query(Event_Ticket).filter(Event_Ticket.ticket_id.in_(
+        ticketIds)).delete(synchronize_session=False)
+    db.session.query(Ticket).filter(Ticket.id.in_(
+        ticketIds)).delete(synchronize_session=False)
+    refreshInventoryFlags(list({purchasableId for (_, purchasableId) in expired}))
+    return len(ticketIds)
+
+
+def reserveCartItems(userId, items):
+    # reserve every line item or none of them; the caller commits or rolls back
+    if not isinstance(items, list) or not items:
+        raise ReservationError("Bad request", 400)
+    lines = []
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("quantity"), int) or item["quantity"] < 1:
+            raise ReservationError("Bad request", 400)
+        try:
+            lines.append((int(item.get("purchasableId")), int(item.get("ticketClassId")), item["quantity"],
+                          sorted({int(eventId) for eventId in item.get("events") or []})))
+        except (TypeError, ValueError):
+            raise ReservationError("Bad request", 400)
+    purchasableIds = sorted({purchasableId for (purchasableId, _, _, _) in lines})
+    eventIds = sorted({eventId for (_, _, _, lineEventIds) in lines for eventId in lineEventIds})
+
+    # lapsed holds on these purchasables count as free capacity
+    while releaseExpiredHolds(purchasableIds=purchasableIds):
+        pass
+
+    # lock the purchasables, then their events, each in id order, so concurrent
+    # reservations for the same inventory queue up instead of overselling
+    purchasables = {purchasable.id: purchasable for purchasable in db.session.query(Purchasable).options(db.noload('*')).filter(
+        Purchasable.id.in_(purchasableIds)).order_by(Purchasable.id).with_for_update()}
+    if len(purchasables) != len(purchasableIds):
+        raise ReservationError("Not found", 404)
+
+    events = {}
+    if eventIds:
+        events = {event.id: event for event in db.session.query(Event).options(db.noload('*')).filter(
+            Event.id.in_(eventIds)).order_by(Event.id).with_for_update()}
+
+    offered = set(db.session.query(Purchasable_TicketClass.purchasable_id, Purchasable_TicketClass.ticketClass_id).filter(
+        Purchasable_TicketClass.purchasable_id.in_(purchasableIds)))
+    purchasableQuantities, eventQuantities = defaultdict(int), defaultdict(int)
+    for purchasableId, ticketClassId, quantity, lineEventIds in lines:
+        if (purchasableId, ticketClassId) not in offered or any(
+                eventId not in events or events[eventId].purchasable_id != purchasableId for eventId in lineEventIds):
+            raise ReservationError("Bad request", 400)
+        purchasableQuantities[purchasableId] += quantity
+        for eventId in lineEventIds:
+            eventQuantities[eventId] += quantity
+
+    if any(purchasable.isSoldOut for purchasable in purchasables.values()) or any(event.isFull for event in events.values()):
+        raise ReservationError("Sold out")
+
+    # the whole cart has to fit, not just each line on its own
+    for purchasableId, quantity in purchasableQuantities.items():
+        purchasable = purchasables[purchasableId]
+        if purchasable.numTickets is not None and purchasable.numTickets - purchasable.soldCount - purchasable.heldCount < quantity:
+            raise ReservationError("Sold out")
+    for eventId, quantity in eventQuantities.items():
+        event = events[eventId]
+        if event.capacity is not None and event.capacity - event.soldCount - event.heldCount < quantity:
+            raise ReservationError("Sold out")
+
+    holdExpiresAt = datetime.utcnow() + timedelta(minutes=CART_HOLD_MINUTES)
+    ticketIds = insertReturningIds(Ticket.__table__, [{
+        "isPurchased": False,
+        "purchasable_id": purchasableId,
+        "ticketClass_id": ticketClassId,
+        "user_id": userId,
+        "holdExpiresAt": holdExpiresAt
+    } for (purchasableId, ticketClassId, quantity, _) in lines for i in range(quantity)])
+
+    # ticket ids come back in the order the rows were listed
+    ticketEvents = [lineEventIds for (_, _, quantity, lineEventIds) in lines for i in range(quantity)]
+    eventTickets = [{"event_id": eventId, "ticket_id": ticketId}
+                    for ticketId, lineEventIds in zip(ticketIds, ticketEvents) for eventId in lineEventIds]
+    if eventTickets:
+        db.session.execute(Event_Ticket.__table__.insert().values(eventTickets))
+        db.session.execute(Event.__table__.update().where(Event.id == db.bindparam('_id')).values(
+            heldCount=Event.heldCount + db.bindparam('quantity')),
+            [{"_id": eventId, "quantity": quantity} for eventId, quantity in sorted(eventQuantities.items())])
+    db.session.execute(Purchasable.__table__.update().where(Purchasable.id == db.bindparam('_id')).values(
+        heldCount=Purchasable.heldCount + db.bindparam('quantity')),
+        [{"_id": purchasableId, "quantity": quantity} for purchasableId, quantity in sorted(purchasableQuantities.items())])
+
+    refreshInventoryFlags(purchasableIds)
+    return ticketIds
+
+
+# Waiting room
+#   With WAITING_ROOM_RATE set, the cart and checkout only serve users holding
+#   an admitted QueueToken, so the database sees at most that many new buyers
+#   a second however many arrive. Each new token is scheduled 1/rate seconds
+#   after the previous one (or now, if the queue has drained), which makes a
+#   user's position and ETA arithmetic on their own row rather than a count.
+class NotAdmitted(Exception):
+    def __init__(self, retryAfter):
+        Exception.__init__(self, retryAfter)
+        self.retryAfter = retryAfter
+
+
+@api.app_errorhandler(NotAdmitted)
+def notAdmitted(error):
+    return "Waiting room, retry shortly", 429, {"Retry-After": str(error.retryAfter)}
+
+
+def currentQueueToken(userId):
+    return db.session.query(QueueToken).filter(
+        QueueToken.user_id == userId, QueueToken.expiresAt > datetime.utcnow()).order_by(QueueToken.id.desc()).first()
+
+
+def issueQueueToken(userId):
+    # one live token per user; asking again returns the same place
+    token = currentQueueToken(userId)
+    if token is not None:
+        return token
+    if db.engine.dialect.name == 'postgresql':
+        # issuers queue on this; the admission checks only read the table
+        db.session.execute('LOCK TABLE "QueueToken" IN SHARE ROW EXCLUSIVE MODE')
+        token = currentQueueToken(userId)
+        if token is not None:
+            return token
+    now = datetime.utcnow()
+    lastAdmitAt = db.session.query(db.func.max(QueueToken.admitAt)).scalar()
+    admitAt = now if lastAdmitAt is None else max(now, lastAdmitAt + timedelta(seconds=1 / WAITING_ROOM_RATE))
+    token = QueueToken(user_id=userId, issueDate=now, admitAt=admitAt,
+                       expiresAt=admitAt + timedelta(minutes=WAITING_ROOM_WINDOW_MINUTES))
+    db.session.add(token)
+    return token
+
+
+def queueStatus(token):
+    if token is None or not WAITING_ROOM_RATE:
+        return {"admitted": True, "position": 0, "eta": 0, "retryAfter": 0, "admitAt": None, "expiresAt": None}
+    wait = max(0.0, (token.admitAt - datetime.utcnow()).total_seconds())
+    return {
+        "admitted": wait == 0,
+        "position": int(-(-wait * WAITING_ROOM_RATE // 1)),  # users still to be let in ahead, this one included
+        "eta": round(wait, 1),
+        "retryAfter": min(WAITING_ROOM_POLL_SECONDS, int(-(-wait // 1))),
+        "admitAt": token.admitAt,
+        "expiresAt": token.expiresAt
+    }
+
+
+def admissionRequired(view, cartHolders=False):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        identity = get_jwt_identity()
+        if WAITING_ROOM_RATE and not identity['isAdmin']:
+            token = currentQueueToken(identity['id'])
+            status = queueStatus(token) if token is not None else None
+            if status is None or not status["admitted"]:
+                hasCart = cartHolders and db.session.query(Ticket.id).filter(
+                    Ticket.user_id == identity['id'], Ticket.isPurchased == False,
+                    Ticket.holdExpiresAt > datetime.utcnow()).first()
+                if not hasCart:
+                    raise NotAdmitted(status["retryAfter"] if status else 0)  # 0: join with POST /waitingRoom/
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def checkoutAdmissionRequired(view):
+    # live cart holds were only handed out after admission, so their holder
+    # can still check them out until they lapse, but not add to the cart
+    return admissionRequired(view, cartHolders=True)
+
+
+# Join the waiting room, or get the place already held
+@api.route("/waitingRoom/", methods=['POST'])
+@jwt_required
+def joinWaitingRoom():
+    identity = get_jwt_identity()
+    if not WAITING_ROOM_RATE:
+        return jsonResponse(queueStatus(None))
+    token = issueQueueToken(identity['id'])
+    db.session.commit()
+    return jsonResponse(queueStatus(token))
+
+
+# Position and ETA in the waiting room; clients poll this every retryAfter seconds
+@api.route("/waitingRoom/", methods=['GET'])
+@jwt_required
+def getWaitingRoomStatus():
+    identity = get_jwt_identity()
+    if not WAITING_ROOM_RATE:
+        return jsonResponse(queueStatus(None))
+    token = currentQueueToken(identity['id'])
+    if token is None:
+        return "Not found", 404
+    return jsonResponse(queueStatus(token))
 
 
 # Create ticket for user
-@app.route("/users/<id>/cart/", methods=['POST'])
+@api.route("/users/<id>/cart/", methods=['POST'])
 @jwt_required
+@admissionRequired
 def addToCart(id):
     identity = get_jwt_identity()
     id = int(id)
     if identity['id'] == id or identity['isAdmin']:
-
-        purchasableId = request.json.get("purchasableId")
-        ticketClassId = request.json.get("ticketClassId")
-        purchasable = db.session.query(Purchasable).filter(
-            Purchasable.id == purchasableId).one()
-        ticketClasses = db.session.query(Purchasable_TicketClass).filter(Purchasable_TicketClass.purchasable_id == purchasable.id).join(
-            TicketClass, Purchasable_TicketClass.ticketClass_id == TicketClass.id).all()
-
-        assert(ticketClassId in [serialize(tc)[
-               'ticketClass_id'] for tc in ticketClasses])
-
-        for i in range(request.json.get("quantity")):
-            ticket = Ticket(
-                isPurchased=False,
-                purchasable_id=purchasableId,
-                ticketClass_id=ticketClassId,
-                user_id=id
-            )
-            db.session.add(ticket)
-            db.session.flush()
-
-            for eventId in request.json.get("events"):
-                event = db.session.query(Event).filter(
-                    Event.id == eventId).one()
-                assert(event.purchasable_id == purchasable.id)
-                relationship = Event_Ticket(
-                    event_id=eventId,
-                    ticket_id=ticket.id
-                )
-                db.session.add(relationship)
+        try:
+            reserveCartItems(id, [request.json])
+        except ReservationError as e:
+            db.session.rollback()
+            return e.message, e.status
         db.session.commit()
         return "Success", 200
     return "Forbidden", 403
 
 
-@app.route("/users/<id>/cart/", methods=['GET'])
+def cartResponse(userId):
+    holdExpiresAt = db.session.query(db.func.min(Ticket.holdExpiresAt)).filter(
+        Ticket.user_id == userId, Ticket.isPurchased == False).scalar()
+    pricing = priceTickets(userId)
+    return jsonResponse({**pricing, "ticketSubTotal": toDollars(pricing["subtotalCents"]), "tax": toDollars(pricing["taxCents"]), "totalPrice": toDollars(pricing["totalCents"]),
+                         "holdExpiresAt": holdExpiresAt, "purchasables": serializeTicketsByPurchasable(getUserTickets(userId, False))})
+
+
+@api.route("/users/<id>/cart/", methods=['GET'])
 @jwt_required
 def getCart(id):
     identity = get_jwt_identity()
     id = int(id)
     if identity['id'] == id or identity['isAdmin']:
-        purchasables = db.session.query(Purchasable).join(
-            Ticket, Ticket.purchasable_id == Purchasable.id).join(TicketClass, TicketClass.id == Ticket.ticketClass_id).join(Event_Ticket, Ticket.id == Event_Ticket.ticket_id).join(Event, Event_Ticket.event_id == Event.id).filter(Ticket.user_id == id, Ticket.isPurchased == False)
-
-        ticketSubTotal = ceil(sum([sum([ticket.ticketClass.price for ticket in purchasable.unpurchasedTickets if ticket.user_id == id])
-                                   for purchasable in purchasables]) * 100) / 100.0
-        tax = ceil(0.13 * ticketSubTotal * 100) / 100.0
-        totalPrice = ceil((ticketSubTotal + tax) * 100) / 100.0
-        return jsonify({"ticketSubTotal": ticketSubTotal, "tax": tax, "totalPrice": totalPrice, "purchasables": [{**serialize(purchasable),
-                                                                                                                  "events": [serialize(event) for event in purchasable.events],
-                                                                                                                  "tickets": [{**serialize(ticket), "ticketClass": serialize(ticket.ticketClass), "events": [serialize(event.event) for event in ticket.events]} for ticket in purchasable.unpurchasedTickets if ticket.user_id == id]} for purchasable in purchasables]})
+        while releaseExpiredHolds(userId=id):
+            pass
+        db.session.commit()
+        return cartResponse(id)
+    return "Forbidden", 403
+
+
+# Add several line items at once, e.g. a group booking; all are reserved or none are
+@api.route("/users/<id>/cart/items/", methods=['POST'])
+@jwt_required
+@admissionRequired
+def addItemsToCart(id):
+    identity = get_jwt_identity()
+    id = int(id)
+    if identity['id'] == id or identity['isAdmin']:
+        try:
+            reserveCartItems(id, request.json.get("items") if isinstance(request.json, dict) else None)
+        except ReservationError as e:
+            db.session.rollback()
+            return e.message, e.status
+        db.session.commit()
+        return cartResponse(id)
     return "Forbidden", 403
 
 # Remove cart item
-@app.route("/users/<id>/cart/<purchasableId>/", methods=['DELETE'])
+@api.route("/users/<id>/cart/<purchasableId>/", methods=['DELETE'])
 @jwt_required
 def deleteCartItem(id, purchasableId):
     identity = get_jwt_identity()
     id = int(id)
     purchasableId = int(purchasableId)
     if identity['id'] == id or identity['isAdmin']:
-        tickets = db.session.query(Ticket).filter(
-            Ticket.purchasable_id == purchasableId, Ticket.user_id == id, Ticket.isPurchased == False).delete()
+        ticketIds = [ticketId for (ticketId,) in db.session.query(Ticket.id).filter(
+            Ticket.purchasable_id == purchasableId, Ticket.user_id == id, Ticket.isPurchased == False).with_for_update().all()]
+        adjustInventoryCounters(ticketIds, held=-1)
+        db.session.query(Event_Ticket).filter(Event_Ticket.ticket_id.in_(
+            ticketIds)).delete(synchronize_session=False)
+        db.session.query(Ticket).filter(Ticket.id.in_(
+            ticketIds)).delete(synchronize_session=False)
+        refreshInventoryFlags([purchasableId])
         db.session.commit()
         return "Success", 200
     return "Forbidden", 403
 
 
-@app.route("/users/<id>/purchased/", methods=['GET'])
+@api.route("/users/<id>/purchased/", methods=['GET'])
 @jwt_required
 def getPurchased(id):
     identity = get_jwt_identity()
     id = int(id)
     if identity['id'] == id or identity['isAdmin']:
-        purchasables = db.session.query(Purchasable).join(
-            Ticket, Ticket.purchasable_id == Purchasable.id).join(TicketClass, TicketClass.id == Ticket.ticketClass_id).join(Event_Ticket, Ticket.id == Event_Ticket.ticket_id).join(Event, Event_Ticket.event_id == Event.id).filter(Ticket.user_id == id, Ticket.isPurchased == True)
-
-        return jsonify({"purchasables": [{**serialize(purchasable),
-                                          "events": [serialize(event) for event in purchasable.events],
-                                          "tickets": [{**serialize(ticket), "ticketClass": serialize(ticket.ticketClass), "events": [serialize(event.event) for event in ticket.events]} for ticket in purchasable.purchasedTickets if ticket.user_id == id]} for purchasable in purchasables]})
+        # pages are cut on ticket id, so one purchasable can span two pages
+        fields = requestFields(Ticket)
+        tickets, limit = pageQuery(userTicketsQuery(id, True), Ticket.id)
+        return pageResponse({"purchasables": serializeTicketsByPurchasable(tickets, fields)}, tickets, limit)
     return "Forbidden", 403
 
+def incrementRollups(buckets):
+    # add to each bucket, creating it on first sale; keys are sorted so
+    # concurrent checkouts lock the shared rows in the same order
+    table = SalesRollup.__table__
+    for (hour, purchasableId, ticketClassId, eventId), (units, grossCents, taxCents) in sorted(buckets.items()):
+        if db.engine.dialect.name == 'postgresql':
+            statement = postgresInsert(table).values(hour=hour, purchasable_id=purchasableId, ticketClass_id=ticketClassId,
+                                                     event_id=eventId, units=units, grossCents=grossCents, taxCents=taxCents)
+            db.session.execute(statement.on_conflict_do_update(index_elements=[
+                table.c.hour, table.c.purchasable_id, table.c.ticketClass_id, table.c.event_id], set_={
+                "units": table.c.units + statement.excluded.units,
+                "grossCents": table.c.grossCents + statement.excluded.grossCents,
+                "taxCents": table.c.taxCents + statement.excluded.taxCents}))
+            continue
+        bucket = db.and_(table.c.hour == hour, table.c.purchasable_id == purchasableId,
+                         table.c.ticketClass_id == ticketClassId, table.c.event_id == eventId)
+        if not db.session.execute(table.update().where(bucket).values(
+                units=table.c.units + units, grossCents=table.c.grossCents + grossCents, taxCents=table.c.taxCents + taxCents)).rowcount:
+            db.session.execute(table.insert().values(hour=hour, purchasable_id=purchasableId, ticketClass_id=ticketClassId,
+                                                     event_id=eventId, units=units, grossCents=grossCents, taxCents=taxCents))
+
+
+def rollupSales(orderIds):
+    # fold the tickets of the given orders into their hourly buckets. The
+    # order's tax is spread over its lines so the sale rows add up to it
+    taxCents = dict(db.session.query(Order.id, Order.taxCents).filter(Order.id.in_(orderIds)))
+    lines = db.session.query(
+        Ticket.order_id, Ticket.purchaseDate, Ticket.purchasable_id, Ticket.ticketClass_id,
+        db.func.count(Ticket.id), db.func.sum(TicketClass.priceCents)).join(
+        TicketClass, TicketClass.id == Ticket.ticketClass_id).filter(
+        Ticket.order_id.in_(orderIds)).group_by(
+        Ticket.order_id, Ticket.purchaseDate, Ticket.purchasable_id, Ticket.ticketClass_id).order_by(
+        Ticket.order_id, Ticket.purchasable_id, Ticket.ticketClass_id).all()
+
+    subtotals = defaultdict(int)
+    for (orderId, _, _, _, _, grossCents) in lines:
+        subtotals[orderId] += grossCents
+    lineTaxes, allocated, firstLines = {}, defaultdict(int), {}
+    for (orderId, _, purchasableId, ticketClassId, _, grossCents) in lines:
+        line = (orderId, purchasableId, ticketClassId)
+        lineTaxes[line] = taxCents[orderId] * grossCents // subtotals[orderId] if subtotals[orderId] else 0
+        allocated[orderId] += lineTaxes[line]
+        firstLines.setdefault(orderId, line)
+    for orderId, line in firstLines.items():  # rounding remainder goes to the order's first line
+        lineTaxes[line] += taxCents[orderId] - allocated[orderId]
+
+    buckets = defaultdict(lambda: [0, 0, 0])
+    lineUnits = {}
+    for (orderId, purchaseDate, purchasableId, ticketClassId, units, grossCents) in lines:
+        bucket = buckets[(purchaseDate.replace(minute=0, second=0, microsecond=0), purchasableId, ticketClassId, 0)]
+        bucket[0] += units
+        bucket[1] += grossCents
+        bucket[2] += lineTaxes[(orderId, purchasableId, ticketClassId)]
+        lineUnits[(orderId, purchasableId, ticketClassId)] = units
+
+    for (orderId, purchaseDate, purchasableId, ticketClassId, eventId, units, grossCents) in db.session.query(
+            Ticket.order_id, Ticket.purchaseDate, Ticket.purchasable_id, Ticket.ticketClass_id, Event_Ticket.event_id,
+            db.func.count(Ticket.id), db.func.sum(TicketClass.priceCents)).join(
+            TicketClass, TicketClass.id == Ticket.ticketClass_id).join(
+            Event_Ticket, Event_Ticket.ticket_id == Ticket.id).filter(
+            Ticket.order_id.in_(orderIds)).group_by(
+            Ticket.order_id, Ticket.purchaseDate, Ticket.purchasable_id, Ticket.ticketClass_id, Event_Ticket.event_id):
+        line = (orderId, purchasableId, ticketClassId)
+        bucket = buckets[(purchaseDate.replace(minute=0, second=0, microsecond=0), purchasableId, ticketClassId, eventId)]
+        bucket[0] += units
+        bucket[1] += grossCents
+        bucket[2] += lineTaxes[line] * units // lineUnits[line]
+
+    incrementRollups(buckets)
+
+
 # Checkout
-@app.route("/checkout/", methods=['POST'])
+@api.route("/checkout/", methods=['POST'])
 @jwt_required
+@checkoutAdmissionRequired
 def checkout():
     identity = get_jwt_identity()
     idempotency_key = b64encode(urandom(32)).decode('utf-8')
@@ -710,24 +2261,28 @@ def checkout():
 
     id = int(identity['id'])
 
-    purchasables = db.session.query(Purchasable).join(
-        Ticket, Ticket.purchasable_id == Purchasable.id).join(TicketClass, TicketClass.id == Ticket.ticketClass_id).join(Event_Ticket, Ticket.id == Event_Ticket.ticket_id).join(Event, Event_Ticket.event_id == Event.id).filter(Ticket.user_id == id, Ticket.isPurchased == False)
-
-    ticketSubTotal = ceil(sum([sum([ticket.ticketClass.price for ticket in purchasable.unpurchasedTickets])
-                               for purchasable in purchasables]) * 100) / 100.0
-
-    tax = ceil(0.13 * ticketSubTotal * 100) / 100.0
-    totalPrice = ceil((ticketSubTotal + tax) * 100) / 100.0
+    # refuse to charge for a cart whose holds have lapsed
+    expiredHolds = db.session.query(db.func.min(Ticket.holdExpiresAt)).filter(
+        Ticket.user_id == id, Ticket.isPurchased == False, Ticket.holdExpiresAt < datetime.utcnow()).scalar()
+    if expiredHolds:
+        while releaseExpiredHolds(userId=id):
+            pass
+        db.session.commit()
+        return jsonResponse({"msg": "Cart hold expired", "holdExpiresAt": expiredHolds}), 409
 
-    numTickets = sum([len(p.unpurchasedTickets) for p in purchasables])
+    # claim the cart; rows a concurrent checkout of this cart already holds are
+    # skipped rather than waited on, so the same tickets are never charged twice
+    ticketIds = [ticketId for (ticketId,) in db.session.query(Ticket.id).filter(
+        Ticket.user_id == id, Ticket.isPurchased == False).order_by(Ticket.id).with_for_update(skip_locked=True).all()]
+    pricing = priceTickets(id, ticketIds=ticketIds)
 
-    description = "{} tickets purchased".format(numTickets)
+    description = "{} tickets purchased".format(pricing["numTickets"])
 
-    if nonce:
+    if nonce and ticketIds:
         body = {
             "source_id": nonce,
             "amount_money": {
-                "amount": totalPrice * 100,  # unit is 0.01 CAD
+                "amount": pricing["totalCents"],  # unit is 0.01 CAD
                 "currency": 'CAD'
             },
             "idempotency_key": idempotency_key,
@@ -735,50 +2290,466 @@ def checkout():
             "buyer_email_address": identity['emailAddress'],
             "statement_description_identifier": description
         }
-        # try:
-        r = square.payments.create_payment(body)
-            
-    
-        #return 'Message has been sent!'
-        tickets = db.session.query(Ticket).join(TicketClass, TicketClass.id == Ticket.ticketClass_id).join(Event_Ticket, Ticket.id == Event_Ticket.ticket_id).filter(Ticket.user_id == identity['id']).all()
-
-        msg = Message('Confirming Purchase', recipients=[identity['emailAddress']])
-        msg.body = 'Congratulations, you have purchased the following tickets:\n' + "\n".join(["{} - {} - {}".format(ticket.ticketClass.price, ticket.ticketClass.description, ', '.join([e.event.name for e in ticket.events])) for ticket in tickets])
-        mail.send(msg)
-        
-        for ticket in tickets:
-            ticket.isPurchased = True
+        r = getSquare().payments.create_payment(body)
+        if r.is_error():
+            return r.text, 402
+
+        order = Order(user_id=id, subtotalCents=pricing["subtotalCents"], taxCents=pricing["taxCents"],
+                      totalCents=pricing["totalCents"], paymentId=r.body.get("payment", {}).get("id"))
+        db.session.add(order)
+        db.session.flush()
+
+        purchasedIds = updateReturningIds(Ticket.__table__, db.and_(Ticket.id.in_(ticketIds), Ticket.isPurchased == False), {
+            "isPurchased": True,
+            "purchaseDate": datetime.utcnow(),
+            "holdExpiresAt": None,
+            "order_id": order.id
+        })
+        adjustInventoryCounters(purchasedIds, held=-1, sold=1)
+        rollupSales([order.id])
+
+        tickets = db.session.query(Ticket).options(*cartProfile).filter(
+            Ticket.order_id == order.id).order_by(Ticket.id).all()
+
+        # the confirmation email is sent by `flask outbox-worker`, committed
+        # together with the order so it can never be lost or sent twice
+        db.session.add(Outbox(kind="confirmationEmail", order_id=order.id, payload=json.dumps({
+            "subject": "Confirming Purchase",
+            "recipients": [identity['emailAddress']],
+            "body": 'Congratulations, you have purchased the following tickets:\n' + "\n".join(["{:.2f} - {} - {}".format(ticket.ticketClass.price, ticket.ticketClass.description, ', '.join([e.event.name for e in ticket.events])) for ticket in tickets])
+        })))
         db.session.commit()
-        return r.text
-        # except Exception as e:
-        #     return e, 500
+        return jsonResponse({"orderId": order.id, "confirmationStatus": OutboxStatus.pending.name, "payment": r.body.get("payment")})
 
     return "Error", 400
 
 
-@app.route('/auth/', methods=['POST'])
+# Get one order and the delivery status of its confirmation
+@api.route("/orders/<id>/", methods=['GET'])
+@jwt_required
+def getOrder(id):
+    identity = get_jwt_identity()
+    order = db.session.query(Order).filter(Order.id == int(id)).one()
+    if identity['id'] == order.user_id or identity['isAdmin']:
+        confirmation = db.session.query(Outbox).filter(
+            Outbox.order_id == order.id, Outbox.kind == "confirmationEmail").first()
+        return jsonResponse({**serialize(order), "confirmationStatus": confirmation.status.name if confirmation else None})
+    return "Forbidden", 403
+
+
+def salesQuery():
+    # ?from=&to= (ISO dates), ?purchasable=, ?ticketClass= and ?event=; raises ValueError on bad input
+    query = db.session.query(SalesRollup).filter(
+        SalesRollup.event_id == int(request.args.get("event", 0)))
+    if "purchasable" in request.args:
+        query = query.filter(SalesRollup.purchasable_id == int(request.args["purchasable"]))
+    if "ticketClass" in request.args:
+        query = query.filter(SalesRollup.ticketClass_id == int(request.args["ticketClass"]))
+    return dateRange(query, SalesRollup.hour,
+                     datetime.fromisoformat(request.args["from"]) if "from" in request.args else None,
+                     datetime.fromisoformat(request.args["to"]) if "to" in request.args else None)
+
+
+# Hourly sales from the rollups, e.g. /analytics/sales/?ticketClass=1&interval=day&from=2020-07-01
+# Pass event=<id> for admissions to one event instead of the sales themselves
+@api.route("/analytics/sales/", methods=['GET'])
+@jwt_required
+def getSales():
+    identity = get_jwt_identity()
+    if not identity['isAdmin']:
+        return "Forbidden", 403
+    interval = request.args.get("interval", "hour")
+    if interval not in ("hour", "day"):
+        return "Bad request", 400
+    try:
+        query = salesQuery()
+    except ValueError:
+        return "Bad request", 400
+
+    sales = OrderedDict()
+    for rollup in query.order_by(SalesRollup.hour, SalesRollup.purchasable_id, SalesRollup.ticketClass_id):
+        start = rollup.hour if interval == "hour" else rollup.hour.replace(hour=0)
+        bucket = sales.setdefault((start, rollup.purchasable_id, rollup.ticketClass_id), {
+            "start": start, "purchasableId": rollup.purchasable_id, "ticketClassId": rollup.ticketClass_id,
+            "eventId": rollup.event_id or None, "units": 0, "grossCents": 0, "taxCents": 0})
+        bucket["units"] += rollup.units
+        bucket["grossCents"] += rollup.grossCents
+        bucket["taxCents"] += rollup.taxCents
+    return jsonResponse(list(sales.values()))
+
+
+# Sales totals per purchasable and ticket class over a range, e.g. /analytics/sales/totals/?from=2020-07-01
+@api.route("/analytics/sales/totals/", methods=['GET'])
+@jwt_required
+def getSalesTotals():
+    identity = get_jwt_identity()
+    if not identity['isAdmin']:
+        return "Forbidden", 403
+    try:
+        query = salesQuery()
+    except ValueError:
+        return "Bad request", 400
+
+    return jsonResponse([{"purchasableId": purchasableId, "ticketClassId": ticketClassId, "units": units, "grossCents": grossCents, "taxCents": taxCents}
+                         for (purchasableId, ticketClassId, units, grossCents, taxCents) in query.with_entities(
+                             SalesRollup.purchasable_id, SalesRollup.ticketClass_id, db.func.sum(SalesRollup.units),
+                             db.func.sum(SalesRollup.grossCents), db.func.sum(SalesRollup.taxCents)).group_by(
+                             SalesRollup.purchasable_id, SalesRollup.ticketClass_id).order_by(
+                             SalesRollup.purchasable_id, SalesRollup.ticketClass_id)])
+
+
+# Exports are column projections read through a server-side cursor, EXPORT_CHUNK_SIZE rows at a time
+def dateRange(query, column, start, end):
+    if start is not None:
+        query = query.filter(column >= start)
+    if end is not None:
+        query = query.filter(column < end)
+    return query
+
+
+def usersExport(start, end, purchasableId):
+    query = dateRange(db.session.query(
+        User.id, User.name, User.emailAddress, User.gender, User.birthDate, User.association, User.isAdmin, User.createDate),
+        User.createDate, start, end)
+    if purchasableId is not None:
+        query = query.filter(db.session.query(Ticket.id).filter(
+            Ticket.user_id == User.id, Ticket.isPurchased == True, Ticket.purchasable_id == purchasableId).exists())
+    return query.order_by(User.id)
+
+
+def ticketsExport(start, end, purchasableId):
+    # one row per ticket and event it admits to
+    query = dateRange(db.session.query(
+        Ticket.id, Ticket.purchaseDate, Ticket.order_id.label("orderId"), User.id.label("userId"), User.name.label("userName"), User.emailAddress,
+        Purchasable.id.label("purchasableId"), Purchasable.name.label("purchasableName"),
+        TicketClass.description.label("ticketClass"), TicketClass.priceCents,
+        Event.id.label("eventId"), Event.name.label("eventName"), Event.venue, Event.startTime).join(
+        User, User.id == Ticket.user_id).join(
+        Purchasable, Purchasable.id == Ticket.purchasable_id).join(
+        TicketClass, TicketClass.id == Ticket.ticketClass_id).outerjoin(
+        Event_Ticket, Event_Ticket.ticket_id == Ticket.id).outerjoin(
+        Event, Event.id == Event_Ticket.event_id).filter(
+        Ticket.isPurchased == True), Ticket.purchaseDate, start, end)
+    if purchasableId is not None:
+        query = query.filter(Ticket.purchasable_id == purchasableId)
+    return query.order_by(Ticket.id, Event.id)
+
+
+def purchasesExport(start, end, purchasableId):
+    numTickets = db.session.query(db.func.count(Ticket.id)).filter(
+        Ticket.order_id == Order.id).correlate(Order).as_scalar().label("numTickets")
+    query = dateRange(db.session.query(
+        Order.id, Order.createDate, Order.paymentId, User.id.label("userId"), User.emailAddress,
+        numTickets, Order.subtotalCents, Order.taxCents, Order.totalCents).join(
+        User, User.id == Order.user_id), Order.createDate, start, end)
+    if purchasableId is not None:
+        query = query.filter(db.session.query(Ticket.id).filter(
+            Ticket.order_id == Order.id, Ticket.purchasable_id == purchasableId).exists())
+    return query.order_by(Order.id)
+
+
+exportQueries = {"users": usersExport, "tickets": ticketsExport, "purchases": purchasesExport}
+
+
+def csvValue(value):
+    if value is None:
+        return ""
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def exportChunks(query, format):
+    columns = [column["name"] for column in query.column_descriptions]
+    rows = query.yield_per(EXPORT_CHUNK_SIZE)
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for count, row in enumerate(rows, 1):
+            writer.writerow([csvValue(value) for value in row])
+            if count % EXPORT_CHUNK_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        chunk = []
+        for row in rows:
+            chunk.append(orjson.dumps(dict(zip(columns, row))))
+            if len(chunk) == EXPORT_CHUNK_SIZE:
+                yield b"\n".join(chunk) + b"\n"
+                chunk = []
+        if chunk:
+            yield b"\n".join(chunk) + b"\n"
+
+
+# Stream an export, e.g. /exports/tickets/?format=csv&from=2020-07-01&to=2020-07-08&purchasable=3
+@api.route("/exports/<kind>/", methods=['GET'])
+@jwt_required
+def getExport(kind):
+    identity = get_jwt_identity()
+    if not identity['isAdmin']:
+        return "Forbidden", 403
+    if kind not in exportQueries:
+        abort(404)
+    format = request.args.get("format", "ndjson")
+    if format not in ("ndjson", "csv"):
+        return "Bad request", 400
+    try:
+        start = datetime.fromisoformat(request.args["from"]) if "from" in request.args else None
+        end = datetime.fromisoformat(request.args["to"]) if "to" in request.args else None
+        purchasableId = int(request.args["purchasable"]) if "purchasable" in request.args else None
+    except ValueError:
+        return "Bad request", 400
+
+    query = exportQueries[kind](start, end, purchasableId)
+    return current_app.response_class(stream_with_context(exportChunks(query, format)),
+                              mimetype="text/csv" if format == "csv" else "application/x-ndjson",
+                              headers={"Content-Disposition": "attachment; filename={}.{}".format(kind, format)})
+
+
+@api.route('/auth/', methods=['POST'])
 def authenticate():
     if not request.is_json:
-        return jsonify({"msg": "Missing JSON in request"}), 400
+        return jsonResponse({"msg": "Missing JSON in request"}), 400
 
     emailAddress = request.json.get('emailAddress', None)
     password = request.json.get('password', None)
 
     if not emailAddress:
-        return jsonify({"msg": "Missing emailAddress parameter"}), 400
+        return jsonResponse({"msg": "Missing emailAddress parameter"}), 400
     if not password:
-        return jsonify({"msg": "Missing password parameter"}), 400
+        return jsonResponse({"msg": "Missing password parameter"}), 400
 
     user = db.session.query(User).filter(
         User.emailAddress == emailAddress).one()
 
     if checkPassword(password, user.password):
+        if needsRehash(user.password):
+            # move the stored hash to the configured cost while we hold the
+            # plain text; a busy pool just leaves it for the next login
+            try:
+                user.password = getHashedPassword(password)
+                db.session.commit()
+            except PasswordBusy:
+                pass
         # Identity can be any data that is json serializable
         access_token = create_access_token(
             identity={'emailAddress': emailAddress, 'id': user.id, 'isAdmin': user.isAdmin})
-        return jsonify(access_token=access_token, emailAddress=emailAddress, userId=user.id, isAdmin=user.isAdmin), 200
-    return jsonify({"msg": "Bad emailAddress or password"}), 401
+        return jsonResponse({"access_token": access_token, "emailAddress": emailAddress, "userId": user.id, "isAdmin": user.isAdmin}), 200
+    return jsonResponse({"msg": "Bad emailAddress or password"}), 401
+
+
+# Release lapsed cart holds, e.g. `flask release-holds --interval 60` as a worker process
+@api.cli.command("release-holds")
+@click.option("--batch-size", default=500, help="Tickets released per transaction.")
+@click.option("--interval", default=0, help="Seconds between sweeps; 0 sweeps once and exits.")
+def releaseHoldsCommand(batch_size, interval):
+    while True:
+        released = 0
+        while True:
+            count = releaseExpiredHolds(batchSize=batch_size)
+            db.session.commit()
+            if not count:
+                break
+            released += count
+        # tokens past their window no longer admit anyone
+        db.session.query(QueueToken).filter(QueueToken.expiresAt < datetime.utcnow()).delete(synchronize_session=False)
+        db.session.commit()
+        click.echo("Released {} expired holds".format(released))
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+def buildOutboxMessage(entry):
+    payload = json.loads(entry.payload)
+    msg = Message(payload["subject"], recipients=payload["recipients"])
+    msg.body = payload["body"]
+    return msg
+
+
+def sendMessages(messages):
+    # send over one SMTP connection (Flask-Mail reconnects every MAIL_MAX_EMAILS)
+    # at no more than MAIL_MAX_PER_SECOND; returns one error or None per message
+    errors = []
+    try:
+        with mail.connect() as connection:
+            lastSent = 0
+            for msg in messages:
+                wait = lastSent + 1.0 / MAIL_MAX_PER_SECOND - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                lastSent = time.time()
+                try:
+                    connection.send(msg)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(e)
+    except Exception as e:  # could not connect, or the connection dropped
+        errors += [e] * (len(messages) - len(errors))
+    return errors
+
+
+def processOutbox(batchSize=50):
+    # claim a batch of due rows; SKIP LOCKED lets several workers share the table
+    entries = db.session.query(Outbox).filter(Outbox.status == OutboxStatus.pending, Outbox.nextAttemptDate <= datetime.utcnow()).order_by(
+        Outbox.id).limit(batchSize).with_for_update(skip_locked=True).all()
+    if not entries:
+        return 0
+    errors = sendMessages([buildOutboxMessage(entry) for entry in entries])
+    for entry, error in zip(entries, errors):
+        entry.attempts += 1
+        if error:
+            entry.lastError = str(error)[:500]
+            if entry.attempts >= OUTBOX_MAX_ATTEMPTS:
+                entry.status = OutboxStatus.failed
+            else:  # exponential backoff: 30s, 1m, 2m, ...
+                entry.nextAttemptDate = datetime.utcnow(
+                ) + timedelta(seconds=30 * 2 ** (entry.attempts - 1))
+        else:
+            entry.status = OutboxStatus.sent
+            entry.sentDate = datetime.utcnow()
+    db.session.commit()
+    return len(entries)
+
+
+# Deliver queued emails, e.g. `flask outbox-worker --interval 5`
+@api.cli.command("outbox-worker")
+@click.option("--batch-size", default=50, help="Messages claimed per transaction.")
+@click.option("--interval", default=0, help="Seconds between polls; 0 drains the queue once and exits.")
+def outboxWorkerCommand(batch_size, interval):
+    while True:
+        while processOutbox(batch_size) == batch_size:
+            pass
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+# Rebuild the sold / held counters from the Ticket table
+@api.cli.command("recount-inventory")
+def recountInventoryCommand():
+    isPurchased = db.case([(Ticket.isPurchased == True, 1)], else_=0)
+    isHeld = db.case([(Ticket.isPurchased == False, 1)], else_=0)
+    db.session.execute(Purchasable.__table__.update().values(
+        soldCount=db.select([db.func.coalesce(db.func.sum(isPurchased), 0)]).where(
+            Ticket.purchasable_id == Purchasable.id).as_scalar(),
+        heldCount=db.select([db.func.coalesce(db.func.sum(isHeld), 0)]).where(
+            Ticket.purchasable_id == Purchasable.id).as_scalar()))
+    db.session.execute(Event.__table__.update().values(
+        soldCount=db.select([db.func.coalesce(db.func.sum(isPurchased), 0)]).where(db.and_(
+            Event_Ticket.event_id == Event.id, Event_Ticket.ticket_id == Ticket.id)).as_scalar(),
+        heldCount=db.select([db.func.coalesce(db.func.sum(isHeld), 0)]).where(db.and_(
+            Event_Ticket.event_id == Event.id, Event_Ticket.ticket_id == Ticket.id)).as_scalar()))
+    refreshInventoryFlags([id for (id,) in db.session.query(Purchasable.id)])
+    db.session.commit()
+    click.echo("Recounted inventory")
+
+
+# Rebuild the sales rollups from the orders, e.g. after a backfill
+@api.cli.command("rebuild-rollups")
+@click.option("--batch-size", default=1000, help="Orders folded in per query")
+def rebuildRollupsCommand(batch_size):
+    if db.engine.dialect.name == 'postgresql':
+        # checkouts wait on their rollup upserts until the rebuild commits,
+        # so none are counted twice or lost
+        db.session.execute('LOCK TABLE "SalesRollup" IN EXCLUSIVE MODE')
+    db.session.query(SalesRollup).delete()
+    lastId, numOrders = 0, 0
+    while True:
+        orderIds = [id for (id,) in db.session.query(Order.id).filter(
+            Order.id > lastId).order_by(Order.id).limit(batch_size)]
+        if not orderIds:
+            break
+        rollupSales(orderIds)
+        lastId, numOrders = orderIds[-1], numOrders + len(orderIds)
+    db.session.commit()
+    click.echo("Rolled up {} orders".format(numOrders))
+
+
+# Load a festival program, e.g. `flask import-catalog lineup.csv --dry-run`
+@api.cli.command("import-catalog")
+@click.argument("program", type=click.File("rb"))
+@click.option("--format", type=click.Choice(["ndjson", "csv"]), help="Defaults to csv for .csv files, else ndjson.")
+@click.option("--dry-run", is_flag=True, help="Report the changes and roll them back.")
+@click.option("--batch-size", default=IMPORT_BATCH_SIZE, help="Rows written per batch of statements.")
+def importCatalogCommand(program, format, dry_run, batch_size):
+    format = format or ("csv" if program.name.endswith(".csv") else "ndjson")
+    started = time.perf_counter()
+    try:
+        diff = importCatalog(programRows(program, format), batch_size)
+    except CatalogImportError as e:
+        db.session.rollback()
+        raise click.ClickException(e.message)
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
 
+    def describe(entry):
+        return entry["name"] + (" ({})".format(entry["purchasable"]) if "purchasable" in entry else "")
+
+    for kind in ("ticketClasses", "purchasables", "events"):
+        for entry in diff[kind]["created"]:
+            click.echo("+ {} {}".format(kind, describe(entry)))
+        for entry in diff[kind]["updated"]:
+            click.echo("~ {} {}: {}".format(kind, describe(entry), ", ".join(
+                "{} {} -> {}".format(field, old, new) for field, (old, new) in sorted(entry["changes"].items()))))
+        click.echo("{}: {} created, {} updated, {} unchanged".format(
+            kind, len(diff[kind]["created"]), len(diff[kind]["updated"]), diff[kind]["unchanged"]))
+    click.echo("links: {} added, {} removed".format(diff["links"]["added"], diff["links"]["removed"]))
+    click.echo("{} in {:.2f}s".format("Dry run, rolled back" if dry_run else "Committed", time.perf_counter() - started))
+
+
+# Measure password verification throughput at the configured cost, e.g. `flask bench-logins --seconds 10`
+@api.cli.command("bench-logins")
+@click.option("--seconds", default=5.0, help="How long to run")
+@click.option("--threads", default=2 * PASSWORD_WORKERS, help="Concurrent login threads")
+def benchLoginsCommand(seconds, threads):
+    hashed = getHashedPassword("benchmark-password")
+    counts = {"ok": 0, "shed": 0}
+    countsLock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def login():
+        while time.monotonic() < deadline:
+            try:
+                checkPassword("benchmark-password", hashed)
+                outcome = "ok"
+            except PasswordBusy:
+                outcome = "shed"
+            with countsLock:
+                counts[outcome] += 1
+
+    started = time.monotonic()
+    workers = [threading.Thread(target=login) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+    cores = min(PASSWORD_WORKERS, os.cpu_count() or 1)
+    click.echo("cost {}: {:.1f} logins/s on {} cores, {:.1f} logins/s per core, {} shed".format(
+        PASSWORD_HASH_ROUNDS, counts["ok"] / elapsed, cores, counts["ok"] / elapsed / cores, counts["shed"]))
+
+
+# Time a cold worker start, e.g. `flask bench-startup --runs 10`
+@api.cli.command("bench-startup")
+@click.option("--runs", default=5, help="Fresh interpreters to start")
+def benchStartupCommand(runs):
+    script = ("import time; started = time.perf_counter(); from src.app import create_app; imported = time.perf_counter(); "
+              "app = create_app(); created = time.perf_counter(); app.test_client().get('/ticketClasses/'); "
+              "print(imported - started, created - imported, time.perf_counter() - created)")
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-W", "ignore", "-c", script], check=True, stdout=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+        timings.append([float(value) for value in output.split()])
+    importing, creating, firstRequest = (statistics.median(column) for column in zip(*timings))
+    click.echo("median of {} runs: import {:.0f}ms, create_app {:.0f}ms, first request {:.0f}ms".format(
+        runs, importing * 1000, creating * 1000, firstRequest * 1000))
 
 if __name__ == '__main__':
-    app.run(host="127.0.0.1", port='8080', debug=True)
+    create_app().run(host="127.0.0.1", port='8080', debug=True)
@@ -0,0 +1,112 @@
+import os
+import sys
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+# the app reads part of its configuration at import time; settings made
+# before this module is imported (loadtest.py makes its own) are kept
+scratch = tempfile.mkdtemp()
+os.environ.update({
+    "CATALOG_GENERATION_FILE": os.path.join(scratch, "catalog-generation"),
+    "REPLICA_DATABASE_URI": "",
+})
+for name, value in (("SQLALCHEMY_DATABASE_URI", "sqlite:///" + os.path.join(scratch, "import.db")),
+                    ("PASSWORD_HASH_ROUNDS", "4"), ("MAIL_SUPPRESS_SEND", "yes"),
+                    ("SQUARE_TOKEN", "test"), ("SQUARE_ENVIRONMENT", "sandbox"),
+                    ("DEBUG_ENABLED", "no"), ("JWT_SECRET_KEY", uuid.uuid4().hex)):
+    os.environ.setdefault(name, value)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import app as folda  # noqa: E402
+
+
+class FakePayment:
+    def __init__(self, body):
+        self.body = body
+        self.text = str(body)
+
+    def is_error(self):
+        return False
+
+
+def createPayment(body):
+    # stands in for square.payments.create_payment
+    return FakePayment({"payment": {"id": "test-" + body["idempotency_key"][:12], "amount_money": body["amount_money"]}})
+
+
+def makeApp(uri):
+    app = folda.create_app({"SQLALCHEMY_DATABASE_URI": uri, "TESTING": True})
+    app.extensions["square"] = SimpleNamespace(payments=SimpleNamespace(create_payment=createPayment))
+    with app.app_context():
+        folda.db.drop_all()
+        folda.db.create_all()
+    folda.catalogCache.clear()
+    return app
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = makeApp("sqlite:///" + str(tmp_path / "test.db"))
+    with app.app_context():
+        yield app
+        folda.db.session.remove()
+
+
+@pytest.fixture
+def postgresApp():
+    # e.g. TEST_POSTGRES_URI=postgresql://localhost/folda_test; the database is wiped
+    uri = os.environ.get("TEST_POSTGRES_URI")
+    if not uri:
+        pytest.skip("TEST_POSTGRES_URI is not set")
+    app = makeApp(uri)
+    with app.app_context():
+        yield app
+        folda.db.session.remove()
+        folda.db.drop_all()
+
+
+def seedCatalog(numPurchasables=3, eventsEach=2, capacity=100000):
+    # day passes, each admitting to its own events, sold in two ticket classes
+    db = folda.db
+    ticketClasses = [folda.TicketClass(description="Adult", priceCents=4500), folda.TicketClass(description="Youth", priceCents=3000)]
+    users = [folda.User(name="Admin", emailAddress="admin@test.invalid", password=folda.hashPassword("admin"), isAdmin=True),
+             folda.User(name="Buyer", emailAddress="buyer@test.invalid", password=folda.hashPassword("buyer"))]
+    db.session.add_all(ticketClasses + users)
+    purchasables = [folda.Purchasable(name="Day {}".format(i), description="Day pass {}".format(i), numTickets=capacity,
+                                      type=folda.PurchasableTypes2.dayPass) for i in range(numPurchasables)]
+    db.session.add_all(purchasables)
+    db.session.flush()
+    for purchasable in purchasables:
+        db.session.add_all([folda.Purchasable_TicketClass(purchasable_id=purchasable.id, ticketClass_id=ticketClass.id)
+                            for ticketClass in ticketClasses])
+        db.session.add_all([folda.Event(purchasable_id=purchasable.id, name="Show {}-{}".format(purchasable.id, i),
+                                        artistName="Artist {}".format(i), description="A show", venue="Hall {}".format(i),
+                                        capacity=capacity, startTime=datetime(2020, 7, purchasable.id, 10 + i),
+                                        endTime=datetime(2020, 7, purchasable.id, 11 + i))
+                            for i in range(eventsEach)])
+    db.session.commit()
+    return SimpleNamespace(purchasableIds=[p.id for p in purchasables], ticketClassIds=[t.id for t in ticketClasses],
+                           adminId=users[0].id, buyerId=users[1].id)
+
+
+def sellTickets(catalog, ticketsEach):
+    # purchased tickets admitting to every event of their purchasable, written in bulk
+    db = folda.db
+    for purchasableId in catalog.purchasableIds:
+        ticketIds = folda.insertReturningIds(folda.Ticket.__table__, [{
+            "isPurchased": True, "purchaseDate": datetime(2020, 6, 1) + timedelta(minutes=i),
+            "purchasable_id": purchasableId, "ticketClass_id": catalog.ticketClassIds[i % 2], "user_id": catalog.buyerId
+        } for i in range(ticketsEach)])
+        eventIds = [id for (id,) in db.session.query(folda.Event.id).filter(folda.Event.purchasable_id == purchasableId)]
+        db.session.execute(folda.Event_Ticket.__table__.insert(), [
+            {"event_id": eventId, "ticket_id": ticketId} for ticketId in ticketIds for eventId in eventIds])
+    db.session.commit()
+
+
+def authHeaders(userId, isAdmin=False, emailAddress="buyer@test.invalid"):
+    token = folda.create_access_token(identity={"id": userId, "isAdmin": isAdmin, "emailAddress": emailAddress})
+    return {"Authorization": "Bearer " + token}
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import orjson
+
+from conftest import authHeaders, folda, seedCatalog
+
+
+def importProgram(app, catalog, rows, dryRun=False):
+    admin = authHeaders(catalog.adminId, isAdmin=True, emailAddress="admin@test.invalid")
+    body = b"\n".join(orjson.dumps(row) for row in rows)
+    return app.test_client().post("/catalog/import/?format=ndjson" + ("&dryRun=yes" if dryRun else ""), data=body, headers=admin)
+
+
+def test_partial_row_changes_only_the_fields_it_gives(app):
+    catalog = seedCatalog(numPurchasables=1)
+    purchasable = folda.db.session.query(folda.Purchasable).get(catalog.purchasableIds[0])
+    event = purchasable.events[0]
+    before = {field: getattr(event, field) for field in folda.eventImportFields}
+    row = {"purchasable": purchasable.name, "event": event.name, "startTime": "2020-07-01T09:30"}
+
+    diff = importProgram(app, catalog, [row], dryRun=True).get_json()
+    assert diff["purchasables"] == {"created": [], "updated": [], "unchanged": 1}
+    assert [update["changes"] for update in diff["events"]["updated"]] == [
+        {"startTime": ["Wed, 01 Jul 2020 10:00:00 GMT", "Wed, 01 Jul 2020 09:30:00 GMT"]}]
+
+    assert importProgram(app, catalog, [row]).status_code == 200
+    folda.db.session.expire_all()
+    assert purchasable.type == folda.PurchasableTypes2.dayPass
+    assert {field: getattr(event, field) for field in folda.eventImportFields} == {**before, "startTime": datetime(2020, 7, 1, 9, 30)}
+
+
+def test_new_rows_get_defaults_and_need_their_times(app):
+    catalog = seedCatalog(numPurchasables=1)
+    row = {"purchasable": "Late Show", "event": "Late Show", "description": "After hours", "capacity": 50,
+           "startTime": "2020-07-01T23:00", "endTime": "2020-07-02T01:00", "ticketClasses": ["Adult"]}
+    response = importProgram(app, catalog, [{key: value for key, value in row.items() if key != "endTime"}])
+    assert response.status_code == 400 and response.get_data(as_text=True) == "line 1: endTime is required"
+
+    assert importProgram(app, catalog, [row]).status_code == 200
+    purchasable = folda.db.session.query(folda.Purchasable).filter_by(name="Late Show").one()
+    assert (purchasable.type, purchasable.numTickets, purchasable.description) == (folda.PurchasableTypes2.individual, 50, "After hours")
+    assert purchasable.events[0].venue is None
+
+
+def test_moved_time_is_checked_against_the_one_kept(app):
+    catalog = seedCatalog(numPurchasables=1)
+    purchasable = folda.db.session.query(folda.Purchasable).get(catalog.purchasableIds[0])
+    row = {"purchasable": purchasable.name, "event": purchasable.events[0].name, "startTime": "2020-07-01T12:00"}
+    response = importProgram(app, catalog, [row])
+    assert response.status_code == 400 and response.get_data(as_text=True) == "line 1: endTime is before startTime"
@@ -0,0 +1,46 @@
+import pytest
+
+from conftest import folda, seedCatalog, sellTickets
+
+
+def catalogReads(app, path):
+    # (statements, rows fetched) for one uncached GET; each SELECT is replayed
+    # on a raw connection to count the rows it returned
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    folda.catalogCache.clear()
+    folda.db.event.listen(folda.db.engine, "before_cursor_execute", record)
+    try:
+        response = app.test_client().get(path)
+    finally:
+        folda.db.event.remove(folda.db.engine, "before_cursor_execute", record)
+    assert response.status_code == 200
+
+    connection = folda.db.engine.raw_connection()
+    try:
+        rows = 0
+        for statement, parameters in statements:
+            if statement.lstrip().upper().startswith("SELECT"):
+                cursor = connection.cursor()
+                cursor.execute(statement, parameters)
+                rows += len(cursor.fetchall())
+                cursor.close()
+    finally:
+        connection.close()
+    return len(statements), rows
+
+
+@pytest.mark.parametrize("path", ["/purchasables/", "/dayPasses/"])
+def test_catalog_reads_stay_flat_as_tickets_sell(app, path):
+    catalog = seedCatalog()
+    sellTickets(catalog, 20)
+    before = catalogReads(app, path)
+
+    sellTickets(catalog, 200)  # ten times the sales
+    after = catalogReads(app, path)
+
+    assert after == before
+    assert before[1] == len(catalog.purchasableIds) * 3  # each purchasable and its two events
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import pytest
+
+from conftest import authHeaders, folda, seedCatalog
+
+
+@pytest.fixture(params=["app", "postgresApp"])
+def anyApp(request):
+    return request.getfixturevalue(request.param)
+
+
+def test_event_saves_back_the_times_it_was_read_with(anyApp):
+    catalog = seedCatalog(numPurchasables=1)
+    admin = authHeaders(catalog.adminId, isAdmin=True, emailAddress="admin@test.invalid")
+    client = anyApp.test_client()
+    eventId = folda.db.session.query(folda.Event.id).first()[0]
+
+    # the edit page sends the event it fetched straight back
+    event = client.get("/events/{}/".format(eventId)).get_json()
+    assert client.put("/events/{}/".format(eventId), json=event, headers=admin).status_code == 200
+
+    folda.db.session.expire_all()
+    saved = folda.db.session.query(folda.Event).get(eventId)
+    assert (saved.startTime, saved.endTime) == (datetime(2020, 7, 1, 10), datetime(2020, 7, 1, 11))
+
+
+@pytest.mark.parametrize("startTime, endTime, status", [
+    ("2020-07-01T10:00:00.000Z", "2020-07-01T11:00:00.000Z", 200),
+    ("Wed, 01 Jul 2020 10:00:00 GMT", "2020-07-01T11:00", 200),
+    ("2020-07-01T10:00", "2020-07-01T10:00", 200),
+    ("2020-07-01T11:00", "2020-07-01T10:00", 400),
+    ("2020-07-01T10:00", "tomorrow", 400),
+    ("2020-07-01T10:00", None, 400),
+])
+def test_event_times_are_validated(app, startTime, endTime, status):
+    catalog = seedCatalog(numPurchasables=1)
+    admin = authHeaders(catalog.adminId, isAdmin=True, emailAddress="admin@test.invalid")
+    eventId = folda.db.session.query(folda.Event.id).first()[0]
+    event = app.test_client().get("/events/{}/".format(eventId)).get_json()
+    response = app.test_client().put("/events/{}/".format(eventId), json={**event, "startTime": startTime, "endTime": endTime}, headers=admin)
+    assert response.status_code == status
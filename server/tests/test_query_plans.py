@@ -0,0 +1,154 @@
+import re
+from datetime import datetime, timedelta
+
+from conftest import authHeaders, folda, seedCatalog, sellTickets
+
+
+# tables that grow with every sale. Reading one without a condition on an
+# index's leading column is a full scan, even when the planner walks an index
+# to do it. Catalog tables stay small and the listings read them whole anyway
+SALES_TABLES = {"Ticket", "Event_Ticket", "Order", "Outbox", "SalesRollup", "QueueToken"}
+
+
+def leadingColumns(cursor):
+    # index name -> (table, first column), to tell a range scan from a walk of the whole index
+    cursor.execute("""SELECT index.relname, tbl.relname, attname FROM pg_index
+                      JOIN pg_class index ON index.oid = indexrelid JOIN pg_class tbl ON tbl.oid = indrelid
+                      JOIN pg_attribute ON attrelid = indrelid AND attnum = indkey[0]""")
+    return {indexName: (table, column) for (indexName, table, column) in cursor.fetchall()}
+
+
+def findFullScans(plan, indexes):
+    found = []
+    if plan["Node Type"] == "Seq Scan" and plan["Relation Name"] in SALES_TABLES:
+        found.append("{} (no index)".format(plan["Relation Name"]))
+    elif plan["Node Type"] in ("Index Scan", "Index Only Scan", "Bitmap Index Scan") \
+            and indexes.get(plan["Index Name"], ("",))[0] in SALES_TABLES:
+        table, column = indexes[plan["Index Name"]]
+        if not re.search(r'(?<![\w"]){0}(?![\w"])|"{0}"'.format(re.escape(column)), plan.get("Index Cond", "")):
+            found.append("{} ({})".format(table, plan["Index Name"]))
+    for child in plan.get("Plans", []):
+        found += findFullScans(child, indexes)
+    return found
+
+
+def seedShoppers(catalog, numUsers, ticketsEach):
+    # other shoppers' orders and live cart holds, so the buyer's rows are as
+    # small a share of each table as they would be during an on-sale
+    db = folda.db
+    userIds = folda.insertReturningIds(folda.User.__table__, [{
+        "name": "Shopper {}".format(i), "emailAddress": "shopper{}@test.invalid".format(i), "password": "-"
+    } for i in range(numUsers)])
+    orderIds = folda.insertReturningIds(folda.Order.__table__, [{
+        "subtotalCents": 4500, "taxCents": 585, "totalCents": 5085, "user_id": userId
+    } for userId in userIds])
+    db.session.execute(folda.Outbox.__table__.insert(), [{
+        "kind": "receipt", "payload": "{}", "status": folda.OutboxStatus.sent, "order_id": orderId
+    } for orderId in orderIds])
+    eventIds = dict(db.session.query(folda.Event.purchasable_id, db.func.min(folda.Event.id)).group_by(folda.Event.purchasable_id))
+    tickets = [{
+        "isPurchased": i % 2 == 0, "order_id": orderId if i % 2 == 0 else None,
+        "purchaseDate": datetime(2020, 6, 1) if i % 2 == 0 else None,
+        "holdExpiresAt": None if i % 2 == 0 else datetime.utcnow() + timedelta(hours=1),
+        "purchasable_id": catalog.purchasableIds[i % len(catalog.purchasableIds)],
+        "ticketClass_id": catalog.ticketClassIds[0], "user_id": userId
+    } for userId, orderId in zip(userIds, orderIds) for i in range(ticketsEach)]
+    ticketIds = folda.insertReturningIds(folda.Ticket.__table__, tickets)
+    db.session.execute(folda.Event_Ticket.__table__.insert(), [
+        {"event_id": eventIds[ticket["purchasable_id"]], "ticket_id": ticketId} for ticketId, ticket in zip(ticketIds, tickets)])
+    db.session.commit()
+
+
+def recordStatements(app, steps):
+    # run the endpoints and background jobs, keeping every statement they issue
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    client = app.test_client()
+    folda.db.event.listen(folda.db.engine, "before_cursor_execute", record)
+    try:
+        for step in steps:
+            folda.catalogCache.clear()
+            step(client)
+            folda.db.session.remove()
+    finally:
+        folda.db.event.remove(folda.db.engine, "before_cursor_execute", record)
+    return statements
+
+
+def endpointSteps(catalog):
+    buyer, admin = authHeaders(catalog.buyerId), authHeaders(catalog.adminId, isAdmin=True, emailAddress="admin@test.invalid")
+    purchasableId, ticketClassId = catalog.purchasableIds[0], catalog.ticketClassIds[0]
+    eventIds = [id for (id,) in folda.db.session.query(folda.Event.id).filter(folda.Event.purchasable_id == purchasableId)]
+    item = {"purchasableId": purchasableId, "ticketClassId": ticketClassId, "quantity": 2, "events": eventIds}
+
+    responses = {}
+
+    def expect(status, method, path, **kwargs):
+        def step(client):
+            response = client.open(path, method=method, **kwargs)
+            assert response.status_code == status, (method, path, response.get_data(as_text=True))
+            responses[path] = response.get_json(silent=True)
+        return step
+
+    def orderPage(client):
+        expect(200, "GET", "/orders/{}/".format(responses["/checkout/"]["orderId"]), headers=buyer)(client)
+
+    cart = "/users/{}/cart/".format(catalog.buyerId)
+    return [
+        expect(200, "GET", "/purchasables/?limit=2"),
+        expect(200, "GET", "/purchasables/{}/".format(purchasableId)),
+        expect(200, "GET", "/dayPasses/"),
+        expect(200, "GET", "/individualEvents/"),
+        expect(200, "GET", "/events/{}/".format(eventIds[0])),
+        expect(200, "GET", "/events/?from=2020-07-01T10:30&to=2020-07-01T12:00&sort=startTime&limit=10"),
+        expect(200, "GET", "/events/?venue=Hall%200&from=2020-07-01&to=2020-07-02"),
+        expect(200, "GET", "/events/overlaps/?venue=Hall%200&from=2020-07-01T10:00&to=2020-07-01T12:00", headers=admin),
+        expect(200, "GET", "/ticketClasses/?limit=10"),
+        expect(200, "GET", "/availability/?ids={}".format(purchasableId)),
+        expect(200, "POST", "/events/{}/notify/".format(eventIds[1]), json={"subject": "Doors", "body": "7pm"}, headers=admin),
+        expect(200, "GET", "/search/?q=arti%20sho"),
+        expect(200, "POST", "/auth/", json={"emailAddress": "buyer@test.invalid", "password": "buyer"}),
+        expect(200, "POST", cart, json=item, headers=buyer),
+        expect(200, "DELETE", "{}{}/".format(cart, purchasableId), headers=buyer),
+        expect(200, "POST", cart + "items/", json={"items": [item, {**item, "quantity": 1}]}, headers=buyer),
+        expect(200, "GET", cart, headers=buyer),
+        expect(200, "POST", "/checkout/", json={"nonce": "cnon:card-nonce-ok"}, headers=buyer),
+        expect(200, "GET", "/users/{}/purchased/?limit=50".format(catalog.buyerId), headers=buyer),
+        orderPage,
+        lambda client: folda.processOutbox(),
+        lambda client: (folda.releaseExpiredHolds(), folda.db.session.commit()),
+    ]
+
+
+def test_endpoint_queries_use_indexes(postgresApp):
+    catalog = seedCatalog(numPurchasables=20)
+    sellTickets(catalog, 20)
+    seedShoppers(catalog, 2000, 10)
+    folda.db.session.execute("ANALYZE")
+    folda.db.session.commit()
+
+    statements = recordStatements(postgresApp, endpointSteps(catalog))
+    assert statements
+
+    # explain each statement with the parameters it ran with; dropping an
+    # index one of them relies on turns its plan into a full scan
+    failures = []
+    connection = folda.db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        indexes = leadingColumns(cursor)
+        for statement, parameters in statements:
+            if statement.lstrip().split(None, 1)[0].upper() not in ("SELECT", "UPDATE", "DELETE", "WITH"):
+                continue
+            cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+            fullScans = findFullScans(cursor.fetchone()[0][0]["Plan"], indexes)
+            if fullScans:
+                failures.append("full scan of {}: {}".format(", ".join(fullScans), " ".join(statement.split())))
+    finally:
+        connection.rollback()
+        connection.close()
+    assert not failures, "\n".join(failures)